@@ -0,0 +1,22 @@
+# envelope profiles for MusicPlayer, chosen per voice by the envelope command. four bytes each:
+#  attack:  how fast a note swells from silence to its attenuation, or INSTANT to start there
+#  decay:   how fast it then falls towards the sustain level
+#  sustain: the sustain level, as steps of attenuation below the note's own (15 dies away completely)
+#  release: how fast it falls silent after notes off
+# rates are masks of the 80 Hz envelope tick: the attenuation moves a step on the ticks where
+# (tick & rate) == 0, so with rate = 2^n - 1 each step takes 2^n ticks.
+# the profile numbers are what util/convert_midi.py picks for each instrument family.
+
+INSTANT = 0xFF
+
+PROFILES = bytes((
+    INSTANT, 3, 3, 3,   # 0: the original envelope: falls three steps and holds until released
+    INSTANT, 7, 15, 1,  # 1: struck (piano, mallets): dies away slowly while held
+    INSTANT, 0, 0, 0,   # 2: organ: full level until released, then stops quickly
+    INSTANT, 1, 15, 0,  # 3: plucked (guitar, bass): dies away quickly
+    1, 15, 2, 3,        # 4: bowed (strings, pads): swells in, holds, and lingers after release
+    0, 7, 2, 1,         # 5: blown (brass, reeds, pipes, leads): swells in quickly and settles a little
+))
+
+# one cycle of vibrato, a step per envelope tick (5 Hz), scaled to +-127
+VIBRATO_WAVE = (0, 49, 90, 117, 127, 117, 90, 49, 0, -49, -90, -117, -127, -117, -90, -49)
@@ -0,0 +1,7 @@
+# generated by util/build_firmware.py; do not edit
+from array import array
+CLOCK_FREQ = 1200000
+LOW = b'\r\r\x0e\x04\x0e\x0b\x0b\r\x02\n\x04\x0f\r\r\x0e\x04\x0e\x0b\x0b\r\x02\n\x04\x0f\r\r\x0e\x04\x0e\x0b\x0b\r\x02\n\x04\x0f\r\r\x0f\x02\x07\x0e\x05\x0f\t\x05\x02\x00\x0f\x0f\x0f\x01\x04\x07\x0b\x0f\x05\n\x01\x08\x0f\x07\x00\t\x02\x0b\x05\x00\n\x05\x00\x0c\x08\x04\x00\x0c\t\x06\x03\x00\r\x0b\x08\x06\x04\x02\x00\x0e\x0c\x0b\t\x08\x07\x05\x04\x03\x02\x01\x00\x0f\x0e\r\r\x0c\x0b\x0b\n\t\t\x08\x08\x08\x07\x07\x06\x06\x06\x05\x05\x05\x04\x04\x04\x04\x04\x03\x03\x03'
+HIGH = b'#!?<852/-*(%#!?<852/-*(%#!?<852/-*(%#!\x1f\x1e\x1c\x1a\x19\x17\x16\x15\x14\x13\x11\x10\x0f\x0f\x0e\r\x0c\x0b\x0b\n\n\t\x08\x08\x08\x07\x07\x06\x06\x06\x05\x05\x05\x04\x04\x04\x04\x03\x03\x03\x03\x03\x02\x02\x02\x02\x02\x02\x02\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+FINE_BASE = 416
+FINE = array('H', [65381, 65145, 64910, 64676, 64443, 64211, 63980, 63749, 63519, 63291, 63062, 62835, 62609, 62383, 62158, 61934, 61711, 61489, 61267, 61046, 60826, 60607, 60389, 60171, 59954, 59738, 59523, 59309, 59095, 58882, 58670, 58458, 58248, 58038, 57829, 57620, 57412, 57206, 56999, 56794, 56589, 56385, 56182, 55980, 55778, 55577, 55377, 55177, 54978, 54780, 54583, 54386, 54190, 53995, 53800, 53606, 53413, 53221, 53029, 52838, 52647, 52458, 52269, 52080, 51893, 51706, 51519, 51334, 51149, 50964, 50781, 50598, 50415, 50234, 50053, 49872, 49693, 49514, 49335, 49157, 48980, 48804, 48628, 48453, 48278, 48104, 47931, 47758, 47586, 47414, 47243, 47073, 46904, 46735, 46566, 46398, 46231, 46065, 45899, 45733, 45568, 45404, 45240, 45077, 44915, 44753, 44592, 44431, 44271, 44112, 43953, 43794, 43636, 43479, 43322, 43166, 43011, 42856, 42701, 42547, 42394, 42241, 42089, 41937, 41786, 41636, 41486, 41336, 41187, 41039, 40891, 40744, 40597, 40450, 40305, 40159, 40015, 39871, 39727, 39584, 39441, 39299, 39157, 39016, 38876, 38735, 38596, 38457, 38318, 38180, 38043, 37905, 37769, 37633, 37497, 37362, 37227, 37093, 36960, 36826, 36694, 36561, 36430, 36298, 36168, 36037, 35907, 35778, 35649, 35521, 35393, 35265, 35138, 35011, 34885, 34759, 34634, 34509, 34385, 34261, 34138, 34015, 33892, 33770, 33648, 33527, 33406, 33286, 33166, 33046, 32927, 32809])
@@ -0,0 +1,72 @@
+import utime
+from machine import Pin
+from music_player import MusicPlayer, LED_SMOOTH
+from playlist import Playlist
+from song_index import SongIndex
+
+# the Pico runs this at power-up: it plays every song on its file system, over and over, without a
+# computer. two buttons, each pulling its GPIO to ground:
+#  NEXT_PIN: skip to the next song (or start again, when stopped)
+#  STOP_PIN: let the current song fade out and wait; press either button to go on
+# connecting with the REPL, or any of the util/ tools, interrupts it as usual.
+
+SONG_DIR = ''
+SHUFFLE = False
+REPEAT = True
+NEXT_PIN = 13
+STOP_PIN = 14
+DEBOUNCE_MS = 200
+LEDS = LED_SMOOTH  # or LED_LEVEL, for lights that follow each voice exactly
+
+class Buttons:
+    def __init__(self, player):
+        self.player = player
+        self.stopped = False
+        self.last_press = utime.ticks_ms()
+        self.next_button = Pin(NEXT_PIN, Pin.IN, Pin.PULL_UP)
+        self.stop_button = Pin(STOP_PIN, Pin.IN, Pin.PULL_UP)
+        self.next_button.irq(self._next, Pin.IRQ_FALLING)
+        self.stop_button.irq(self._stop, Pin.IRQ_FALLING)
+
+    def _pressed(self):
+        # contacts bounce, so a press counts only once every DEBOUNCE_MS
+        now = utime.ticks_ms()
+        if utime.ticks_diff(now, self.last_press) < DEBOUNCE_MS:
+            return False
+        self.last_press = now
+        return True
+
+    def _next(self, _pin):
+        if self._pressed():
+            if self.stopped:
+                self.stopped = False
+            else:
+                self.player.skip()
+
+    def _stop(self, _pin):
+        if self._pressed():
+            self.stopped = not self.stopped
+            if self.stopped:
+                self.player.skip()
+
+    def hold(self, songs):
+        # the songs, each held back for as long as the player is stopped
+        for song in songs:
+            while self.stopped:
+                utime.sleep_ms(20)
+            yield song
+
+def main():
+    player = MusicPlayer(leds=LEDS)
+    start = utime.ticks_ms()
+    index = SongIndex(SONG_DIR).update()
+    songs = index.playable(player.voices)
+    # ticks_ms counts from reset, so this includes MicroPython starting up
+    print('{} songs ({} min), {} scanned in {} ms; first song {} ms after reset'.format(
+        len(songs), index.duration() // 60000, index.scanned, utime.ticks_diff(utime.ticks_ms(), start), utime.ticks_ms()))
+    if songs:
+        buttons = Buttons(player)
+        player.play_songs(buttons.hold(Playlist(songs, SHUFFLE, REPEAT)))
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,137 @@
 import utime
 import math
+import sys
 from array import array
 from machine import Pin, PWM, Timer
 from sound import Sound
+from envelopes import INSTANT, PROFILES, VIBRATO_WAVE
+try:
+    import frequency_table  # generated by util/build_firmware.py
+except ImportError:
+    frequency_table = None
 
 def read_words(filename):
+    # opens the file and reads its first buffer straight away, so a song can be made ready before
+    # it's due; iterating the result gives its command words
+    file = open(filename, 'rb', buffering=0)
     buffer = bytearray(128)
-    with open(filename, 'rb', buffering=0) as file:
-        while True:
-            n = file.readinto(buffer)
-            if n == 0:
-                break
+    return _words(file, buffer, file.readinto(buffer))
+
+def _words(file, buffer, n):
+    try:
+        while n:
             i = 0
             while i + 1 < n:
                 yield (buffer[i] << 8) | buffer[i + 1]
                 i += 2
+            n = file.readinto(buffer)
+    finally:
+        file.close()
+
+# pitch bends and vibrato are in sixteenths of a semitone (fine steps)
+FINE_STEPS = 16
+FINE_OCTAVE = 12 * FINE_STEPS
+FINE_BITS = 6
+
+# the clock command's unit, so one byte covers the chips' whole range
+CLOCK_STEP = 20_000
+# frequency tables kept for clocks other than the default, so alternating songs don't recompute them
+CLOCK_TABLES = 4
+
+# what the lights show, updated once per envelope tick:
+LED_LEVEL = 0   # each voice's light follows its attenuation
+LED_SMOOTH = 1  # lights jump up with each note but fall back gently, like a VU meter
 
 class MusicPlayer:
     LED_PINS = [16, 17, 18, 15, 19, 20, 21, 22]
-    def __init__(self):
-        self.sound = Sound()
+    def __init__(self, chips = Sound.CHIPS, leds = LED_LEVEL):
+        self.sound = Sound(chips=chips)
+        self.voices = self.sound.voices
+        self.default_clock = self.sound.clock_freq
+        self.tables = {}    # clock: (freq_low, freq_high, fine_base, fine)
         self._init_frequency_table()
-        self.atten = [15] * 8
-        self.target = [15] * 8
-        self.decay_mask = [3] * 8
-        self.decay_clock = 0
+        self.atten = [15] * self.voices
+        self.target = [15] * self.voices
+        self.sustain = [15] * self.voices   # where the envelope goes once the attack reaches target
+        self.step_mask = [3] * self.voices  # rate of the envelope's current stage (see envelopes.py)
+        self.envelope = [0] * self.voices   # offset of each voice's profile in PROFILES
+        self.envelope_clock = 0
+        self.note = [-1] * self.voices      # the note each tone voice last played
+        self.period = [0] * self.voices     # and the frequency register it was last set to
+        self.bend = [0] * self.voices       # in fine steps
+        self.vibrato = [0] * self.voices    # depth in fine steps
+        self.voice_base = 0   # voice numbers in commands are relative to the selected bank (pair of chips)
+        self.skipping = False   # set by skip() to end the song play_songs is playing
+        self.led_mode = leds
         self._init_leds()
         self.timer = Timer()
 
     def play_song(self, filename):
+        open(filename, 'rb').close()    # play_songs skips a file it can't open, but one song raises OSError
+        self.play_songs((filename,))
+
+    def play_songs(self, songs, gap_ms=0):
+        # plays the files in songs (a Playlist, or any iterable of filenames) one after another
+        # without stopping the timer or the sound in between. each song's last notes fade while
+        # the next one's file is opened, and it starts gap_ms after the last one's final delay.
+        # it stops early if songs comes round to a file again without having played anything since
         try:
+            self.skipping = False
             self.start_playing()
-            cmd_time = utime.ticks_ms()
-            for word in read_words(filename):
-                cmd_time = self.play_word(word, cmd_time)
+            songs = iter(songs)
+            unplayable = set()   # the files that failed to open, or were empty, since a song last played
+            filename, words = self._next_song(songs, unplayable)
+            cmd_time = utime.ticks_us()
+            while words:
+                try:
+                    word = next(words)
+                except StopIteration:
+                    unplayable.add(filename)    # an empty file
+                else:
+                    unplayable.clear()
+                    # the clock only changes when it has to: a song without a clock command plays at the default
+                    if word & 0xFF00 != 0xC400:
+                        self._set_clock(self.default_clock)
+                    cmd_time = self.play_word(word, cmd_time)
+                    for word in words:
+                        cmd_time = self.play_word(word, cmd_time)
+                        if self.skipping:
+                            words.close()
+                            self._notes_off((1 << self.voices) - 1)
+                            self.skipping = False
+                            break
+                filename, words = self._next_song(songs, unplayable)
+                if words:
+                    # a song can't start before its file is ready (or while the playlist holds it back)
+                    now = utime.ticks_us()
+                    if utime.ticks_diff(now, cmd_time) > 0:
+                        cmd_time = now
+                    cmd_time = self._wait(cmd_time, gap_ms * 1000)
+                    self.skipping = False   # a skip during the gap (or while the file opened) was for the last song
+                    self._reset_voices()
             utime.sleep_ms(1000)
         finally:
+            self.skipping = False
             self.finish_playing()
 
+    def skip(self):
+        # ends the current song of play_songs (letting its notes fade) and goes on to the next.
+        # safe to call from an interrupt handler
+        self.skipping = True
+
+    def _next_song(self, songs, unplayable):
+        # (filename, words) of the next song that opens, or (None, None) at the end of songs or when
+        # it comes round to a file in unplayable (so a repeating playlist of bad files doesn't spin forever)
+        for filename in songs:
+            if filename in unplayable:
+                break
+            try:
+                return filename, read_words(filename)
+            except OSError as e:
+                print('{}: {}'.format(filename, e))     # skip it, rather than stop the whole playlist
+                unplayable.add(filename)
+        return None, None
+
     def play_words(self, words, cmd_time):
         try:
             for word in words:
@@ -47,6 +141,23 @@ class MusicPlayer:
             self.finish_playing()
             raise
 
+    def play_live(self):
+        # plays command words as they arrive on stdin, as one line of hex digits per MIDI message,
+        # until an empty line. there are no delays: each line is played as soon as it's read, and
+        # acknowledged with \x06 so the host can measure the latency. start_playing() first.
+        self._set_clock(self.default_clock)     # live words never carry a clock command
+        try:
+            while True:
+                line = sys.stdin.readline().strip()
+                if not line:
+                    break
+                for i in range(0, len(line) - 3, 4):
+                    self.play_word(int(line[i:i + 4], 16), 0)
+                sys.stdout.write('\x06')
+        except KeyboardInterrupt:
+            self.finish_playing()
+            raise
+
     def play_word(self, word, cmd_time):
         cmd = (word >> 14) & 0x3
         if cmd == 0:
@@ -55,10 +166,10 @@ class MusicPlayer:
             #  0  0 V2 V1 V0 A3 A2 A1 A0 N6 N5 N4 N3 N2 N1 N0
             note = word & 0x7F
             attenuation = (word & 0x780) >> 7
-            voice = (word & 0x3800) >> 11
+            voice = self.voice_base + ((word & 0x3800) >> 11)
             self._note_on(voice, note, attenuation)
 
-        elif cmd == 1:
+        elif word < 0x4800:
             # noise on: V = voice; A = attenuation; S = sustain; N = noise type
             # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
             #  0  1  0  0  0 V0 S2 S1 S0 A3 A2 A1 A0 N2 N1 N0
@@ -66,30 +177,84 @@ class MusicPlayer:
             atten = (word & 0b1111000) >> 3
             sustain = (word & 0b1110000000) >> 7
             voice = (word & 0b10000000000) >> 10
-            voice = 3 + (voice * 4)
+            voice = self.voice_base + 3 + (voice * 4)
             self._noise_on(voice, noise, sustain, atten)
 
+        elif word < 0x5000:
+            # pitch bend: V = voice; B = bend in fine steps, signed
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  0  1  0  0  1 V2 V1 V0 B7 B6 B5 B4 B3 B2 B1 B0
+            bend = word & 0xFF
+            if bend > 127:
+                bend -= 256
+            self._bend(self.voice_base + ((word >> 8) & 0x7), bend)
+
+        elif word < 0x6000:
+            # long delay: D = delay in units of 2^20 microseconds (about a second)
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  0  1  0  1 DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
+            for _ in range(word & 0xFFF):
+                cmd_time = self._wait(cmd_time, 1 << 20)
+
+        elif word < 0x8000:
+            # short delay: D = delay in microseconds
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  0  1  1 DC DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
+            cmd_time = self._wait(cmd_time, word & 0x1FFF)
+
         elif cmd == 2:
             # delay: D = delay in milliseconds
             # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
             #  1  0 DD DC DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
-            ms = word & 0x3FFF
-            # TODO figure out why utime.sleep_ms() sometimes failed to wake up
-            # and then be a bit nicer to the Pico by avoiding this busy wait
-            cmd_time = utime.ticks_add(cmd_time, ms)
-            while utime.ticks_diff(cmd_time, utime.ticks_ms()) > 0:
-                pass
+            cmd_time = self._wait(cmd_time, (word & 0x3FFF) * 1000)
 
-        else:
+        elif word < 0xC100:
             # notes off: C = channel; V = voice mask
             # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
             #  1  1  0  0  0  0  0  0 V7 V6 V5 V4 V3 V2 V1 V0
             mask = word & 0xFF
-            self._notes_off(mask)
+            self._notes_off(mask << self.voice_base)
+
+        elif word < 0xC200:
+            # bank select: B = pair of chips that following voice numbers refer to
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  1  1  0  0  0  0  0  1 B7 B6 B5 B4 B3 B2 B1 B0
+            self.voice_base = (word & 0xFF) * 8
+
+        elif word < 0xC300:
+            # envelope: V = voice; P = profile in envelopes.PROFILES, for the voice's next notes
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  1  1  0  0  0  0  1  0 V2 V1 V0 P4 P3 P2 P1 P0
+            voice = self.voice_base + ((word >> 5) & 0x7)
+            self._set_envelope(voice, word & 0x1F)
+
+        elif word < 0xC400:
+            # vibrato: V = voice; D = depth in fine steps
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  1  1  0  0  0  0  1  1 V2 V1 V0 D4 D3 D2 D1 D0
+            voice = self.voice_base + ((word >> 5) & 0x7)
+            if voice < self.voices:
+                self.vibrato[voice] = word & 0x1F
+
+        elif word < 0xC500:
+            # clock: C = the chips' clock in units of CLOCK_STEP, or 0 for the default; at the start of a song
+            # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+            #  1  1  0  0  0  1  0  0 C7 C6 C5 C4 C3 C2 C1 C0
+            self._set_clock((word & 0xFF) * CLOCK_STEP or self.default_clock)
+
+        return cmd_time
 
+    def _wait(self, cmd_time, us):
+        # TODO figure out why utime.sleep_ms() sometimes failed to wake up
+        # and then be a bit nicer to the Pico by avoiding this busy wait
+        cmd_time = utime.ticks_add(cmd_time, us)
+        while utime.ticks_diff(cmd_time, utime.ticks_us()) > 0:
+            if self.skipping:
+                return utime.ticks_us()     # the rest of the delay is skipped too, so time goes on from now
         return cmd_time
 
     def start_playing(self):
+        self._reset_voices()
         self.timer.init(freq=80, mode=Timer.PERIODIC, callback=self._process_envelopes)
 
     def finish_playing(self):
@@ -97,14 +262,70 @@ class MusicPlayer:
         self._lights_off()
         self.sound.silence()
 
+    def _reset_voices(self):
+        # songs start with every voice on profile 0, unbent and without vibrato, and bank 0 selected.
+        # notes still fading from the song before keep their own release
+        self.envelope = [0] * self.voices
+        self.bend = [0] * self.voices
+        self.vibrato = [0] * self.voices
+        self.voice_base = 0
+
+    def _set_clock(self, clock_freq):
+        if clock_freq != self.sound.clock_freq:
+            self.sound.set_clock(clock_freq)
+            self._init_frequency_table()
+
     def _init_frequency_table(self):
-        self.frequency_table = array('H') # unsigned short
-        n = Sound.CLOCK_FREQ / (32 * 440)
+        # the table is kept as the two bytes Sound sends: the low four bits and the high six bits of the register.
+        # the tables are swapped in with one assignment, which the envelope timer can't interrupt, since
+        # it retunes notes (still fading, when the clock changes between songs) from them
+        clock = self.sound.clock_freq
+        if frequency_table and frequency_table.CLOCK_FREQ == clock:
+            tables = (frequency_table.LOW, frequency_table.HIGH, frequency_table.FINE_BASE, frequency_table.FINE)
+        elif clock in self.tables:
+            tables = self.tables[clock]
+        else:
+            tables = self._make_frequency_tables(clock)
+            if len(self.tables) >= CLOCK_TABLES:
+                self.tables.pop(next(iter(self.tables)))
+            self.tables[clock] = tables
+        self.freq_low, self.freq_high, self.fine_base, self.fine = tables
+
+    def _make_frequency_tables(self, clock):
+        freq_low = bytearray(128)
+        freq_high = bytearray(128)
+        n = clock / (32 * 440)
         for midi_note in range(128):
             f = n / math.pow(2, (midi_note - 69.0) / 12)
             while f > 1023:
                 f /= 2  # shift notes that won't fit into the frequency register up an octave until they do
-            self.frequency_table.append(round(f))
+            f = round(f)
+            freq_low[midi_note] = f & 0x0F
+            freq_high[midi_note] = f >> 4
+        # the lowest octave of fine steps that fits in the register, with FINE_BITS more precision;
+        # _fine_period shifts it down for the octaves above
+        fine_base = 0
+        while n / math.pow(2, (fine_base / FINE_STEPS - 69.0) / 12) > 1023:
+            fine_base += 1
+        fine = array('H', [round(n / math.pow(2, ((fine_base + step) / FINE_STEPS - 69.0) / 12) * (1 << FINE_BITS))
+                           for step in range(FINE_OCTAVE)])
+        return freq_low, freq_high, fine_base, fine
+
+    def _fine_period(self, note, offset):
+        # the frequency register for note bent by offset fine steps; pitches below the table are
+        # folded up an octave at a time, like the note table
+        step = note * FINE_STEPS + offset - self.fine_base
+        shift = FINE_BITS
+        if step > 0:
+            shift += step // FINE_OCTAVE
+        return (self.fine[step % FINE_OCTAVE] + (1 << (shift - 1))) >> shift
+
+    def _pitch_period(self, voice):
+        # the frequency register for the voice's note, its bend and the vibrato's current phase
+        offset = self.bend[voice]
+        if self.vibrato[voice]:
+            offset += (self.vibrato[voice] * VIBRATO_WAVE[self.envelope_clock & 15]) >> 7
+        return self._fine_period(self.note[voice], offset)
 
     def _init_leds(self):
         self.pwms = []
@@ -116,42 +337,131 @@ class MusicPlayer:
                 pwm.freq(120)
                 pwm.duty_u16(0)
                 self.pwms.append(pwm)
+        # voices on extra chips don't get lights
+        while len(self.pwms) < self.voices:
+            self.pwms.append(None)
+        self.led_target = [0] * self.voices     # the duty each light should show
+        self.led_duty = [0] * self.voices       # and the duty it was last set to
+        self.leds_dirty = 0     # bit mask of the lights whose target has changed since the last tick
+        self.leds_easing = 0    # and of those still falling towards it, with LED_SMOOTH
 
     def _lights_off(self):
         for pwm in self.pwms:
             if pwm:
                 pwm.duty_u16(0)
+        self.led_target = [0] * self.voices
+        self.led_duty = [0] * self.voices
+        self.leds_dirty = 0
+        self.leds_easing = 0
 
     def _set_led_intensity(self, voice, atten):
+        # only noted here; _flush_leds sets the PWMs from the envelope timer, off the path of the notes
         if self.pwms[voice]:
-            duty = 0xfff0 >> atten
-            self.pwms[voice].duty_u16(duty)
+            self.led_target[voice] = 0xfff0 >> atten
+            self.leds_dirty |= 1 << voice
+
+    def _flush_leds(self):
+        # a note-on in the main loop can't lose its bit to this: if the timer interrupts between its
+        # read and write of leds_dirty, the write only puts back bits that have been flushed already
+        dirty = self.leds_dirty | self.leds_easing
+        self.leds_dirty = 0
+        easing = 0
+        voice = 0
+        while dirty:
+            if dirty & 1:
+                duty = self.led_target[voice]
+                shown = self.led_duty[voice]
+                if self.led_mode == LED_SMOOTH and duty < shown:
+                    duty = shown - ((shown - duty + 7) >> 3)
+                    if duty != self.led_target[voice]:
+                        easing |= 1 << voice
+                if duty != shown:
+                    self.led_duty[voice] = duty
+                    self.pwms[voice].duty_u16(duty)
+            dirty >>= 1
+            voice += 1
+        self.leds_easing = easing
+
+    def _set_envelope(self, voice, profile):
+        if voice < self.voices and profile * 4 < len(PROFILES):
+            self.envelope[voice] = profile * 4
 
     def _note_on(self, voice, note, attenuation):
+        envelope = self.envelope[voice]
+        sustain = min(attenuation + PROFILES[envelope + 2], 15)
+        self.sustain[voice] = sustain
+        if PROFILES[envelope] == INSTANT:
+            self.target[voice] = sustain
+            self.step_mask[voice] = PROFILES[envelope + 1]
+        else:
+            # swell in from silence; _process_envelopes moves on to the decay when it gets there
+            self.target[voice] = attenuation
+            self.step_mask[voice] = PROFILES[envelope]
+            attenuation = 15
         self.atten[voice] = attenuation
-        self.target[voice] = min(attenuation + 3, 15)
-        self.sound.set_frequency(voice, self.frequency_table[note])
+        self.note[voice] = note
+        if self.bend[voice] or self.vibrato[voice]:
+            self.period[voice] = self._pitch_period(voice)
+            self.sound.set_frequency(voice, self.period[voice])
+        else:
+            low = self.freq_low[note]
+            high = self.freq_high[note]
+            self.period[voice] = low | (high << 4)
+            self.sound.set_frequency_bytes(voice, low, high)
         self.sound.set_attenuation(voice, attenuation)
         self._set_led_intensity(voice, attenuation)
 
+    def _bend(self, voice, bend):
+        # retunes the voice's note straight away; later notes on the voice start bent
+        if voice >= self.voices:
+            return
+        self.bend[voice] = bend
+        if self.note[voice] >= 0:
+            period = self._pitch_period(voice)
+            if period != self.period[voice]:
+                self.period[voice] = period
+                self.sound.set_frequency(voice, period)
+
     def _noise_on(self, voice, noise, sustain, attenuation):
         self.atten[voice] = attenuation
         self.target[voice] = 15
-        self.decay_mask[voice] = sustain
+        self.sustain[voice] = 15
+        self.step_mask[voice] = sustain
         self.sound.set_noise(voice, noise)
         self.sound.set_attenuation(voice, attenuation)
         self._set_led_intensity(voice, attenuation)
 
     def _notes_off(self, mask):
-        for voice in range(8):
+        for voice in range(self.voices):
             if 0 != (mask & (1 << voice)):
                 self.target[voice] = 15
+                self.sustain[voice] = 15
+                self.step_mask[voice] = PROFILES[self.envelope[voice] + 3]
 
     def _process_envelopes(self, _timer):
-        self.decay_clock = (self.decay_clock + 1) & 7
-        for voice in range(8):
-            if (self.decay_mask[voice] & self.decay_clock) == 0:
-                if self.atten[voice] < self.target[voice]:
-                    self.atten[voice] += 1
-                    self.sound.set_attenuation(voice, self.atten[voice])
-                    self._set_led_intensity(voice, self.atten[voice])
+        clock = self.envelope_clock = (self.envelope_clock + 1) & 0xFF
+        for voice in range(self.voices):
+            if self.vibrato[voice] and self.note[voice] >= 0 and self.atten[voice] < 15:
+                period = self._pitch_period(voice)
+                if period != self.period[voice]:
+                    self.period[voice] = period
+                    self.sound.queue_frequency(voice, period)
+            if (self.step_mask[voice] & clock) == 0:
+                atten = self.atten[voice]
+                target = self.target[voice]
+                if atten < target:
+                    atten += 1
+                elif atten > target:
+                    atten -= 1
+                else:
+                    if atten < self.sustain[voice]:
+                        # the attack is over: decay towards the sustain level
+                        self.target[voice] = self.sustain[voice]
+                        self.step_mask[voice] = PROFILES[self.envelope[voice] + 1]
+                    continue
+                self.atten[voice] = atten
+                self.sound.set_attenuation(voice, atten)
+                self._set_led_intensity(voice, atten)
+        # the vibrato's frequency writes go out together, then the lights
+        self.sound.flush()
+        self._flush_leds()
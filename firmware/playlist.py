@@ -0,0 +1,38 @@
+import random
+
+# the order MusicPlayer.play_songs plays song files in: as given or shuffled, once through or
+# repeating (and reshuffling) for as long as the player runs
+
+class Playlist:
+    def __init__(self, filenames, shuffle=False, repeat=False):
+        self.filenames = list(filenames)
+        self.shuffle = shuffle
+        self.repeat = repeat
+        self.order = []
+        self.position = 0
+        self._new_pass()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= len(self.order):
+            if not self.repeat or not self.order:
+                raise StopIteration
+            self._new_pass()
+        self.position += 1
+        return self.filenames[self.order[self.position - 1]]
+
+    def _new_pass(self):
+        last = self.order[-1] if self.order else None
+        order = list(range(len(self.filenames)))
+        if self.shuffle:
+            # MicroPython's random has no shuffle
+            for i in range(len(order) - 1, 0, -1):
+                j = random.randrange(i + 1)
+                order[i], order[j] = order[j], order[i]
+            # and a new pass shouldn't start with the song that ended the last one
+            if len(order) > 1 and order[0] == last:
+                order[0], order[-1] = order[-1], order[0]
+        self.order = order
+        self.position = 0
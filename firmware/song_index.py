@@ -0,0 +1,97 @@
+import uos
+from music_player import read_words
+
+# the songs on the Pico's file system, for main.py to play without a computer. finding a song's
+# length means reading every word of it, so what's found is kept in INDEX_FILE, one line per song:
+#   name  size in bytes  duration in ms  voices it plays (one more than the highest voice number)
+# at boot only the directory listing is read, and just the songs that are new or have changed
+# size are scanned again.
+
+INDEX_FILE = 'songs.idx'
+INDEX_HEADER = '# pico-player song index 2\n'
+
+def scan_song(filename):
+    # (duration in ms, voices) from the song's delays and the voices of its note and noise commands,
+    # decoded as MusicPlayer.play_word does. those are the commands that need their voice to exist
+    us = 0
+    voices = 0
+    voice_base = 0
+    for word in read_words(filename):
+        if word < 0x4800:
+            if word < 0x4000:
+                voice = voice_base + ((word >> 11) & 0x7)
+            else:
+                voice = voice_base + 3 + ((word >> 8) & 0x4)
+            if voice >= voices:
+                voices = voice + 1
+        elif word < 0x5000:
+            continue
+        elif word < 0x6000:
+            us += (word & 0xFFF) << 20
+        elif word < 0x8000:
+            us += word & 0x1FFF
+        elif word < 0xC000:
+            us += (word & 0x3FFF) * 1000
+        elif word & 0xFF00 == 0xC100:
+            voice_base = (word & 0xFF) * 8
+    return us // 1000, voices
+
+class SongIndex:
+    def __init__(self, directory=''):
+        self.directory = directory
+        self.songs = {}         # name: (size, duration in ms, voices)
+        self.scanned = 0        # how many songs the last update() had to read
+
+    def path(self, name):
+        return self.directory + '/' + name if self.directory else name
+
+    def load(self):
+        self.songs = {}
+        try:
+            with open(self.path(INDEX_FILE)) as f:
+                if f.readline() != INDEX_HEADER:
+                    return
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 4:
+                        self.songs[fields[0]] = (int(fields[1]), int(fields[2]), int(fields[3]))
+        except (OSError, ValueError):
+            self.songs = {}     # no index yet (or a broken one): everything is scanned
+
+    def save(self):
+        with open(self.path(INDEX_FILE), 'w') as f:
+            f.write(INDEX_HEADER)
+            for name in sorted(self.songs):
+                size, duration, voices = self.songs[name]
+                f.write('{}\t{}\t{}\t{}\n'.format(name, size, duration, voices))
+
+    def update(self):
+        # brings the index up to date with the directory, saving it if anything changed
+        self.load()
+        found = {}
+        self.scanned = 0
+        for entry in uos.ilistdir(self.directory or '.'):
+            name, kind = entry[0], entry[1]
+            if kind != 0x8000 or not name.endswith('.dat'):
+                continue
+            size = entry[3] if len(entry) > 3 else uos.stat(self.path(name))[6]
+            known = self.songs.get(name)
+            if known and known[0] == size:
+                found[name] = known
+            else:
+                found[name] = (size,) + scan_song(self.path(name))
+                self.scanned += 1
+        if found != self.songs:
+            self.songs = found
+            try:
+                self.save()
+            except OSError:
+                pass    # a read-only file system just means scanning again next time
+        return self
+
+    def playable(self, voices):
+        # the paths of the songs that a player with this many voices can play, by name
+        return [self.path(name) for name in sorted(self.songs) if self.songs[name][2] <= voices]
+
+    def duration(self):
+        return sum(song[1] for song in self.songs.values())
@@ -1,11 +1,14 @@
-# control a pair of TI SN76489 programmable sound generator ICs
-# wiring: base pin on LSB (both chips in parallel)
+# control two (or up to four) TI SN76489 programmable sound generator ICs
+# wiring: base pin on LSB (all chips in parallel)
 #         base pin + 8 on left chip /WE
 #         base pin + 9 on right chip /WE
 #         base pin + 10 on left chip /OE
 #         base pin + 11 on right chip /OE
 #         both chips' READY disconnected
+# with more than two chips, base pin + 8 + n goes to chip n's /WE, and every chip's /OE is tied low
 
+import utime
+from array import array
 from rp2 import PIO, asm_pio, StateMachine
 from machine import Pin
 
@@ -20,27 +23,65 @@ def _xfer_prog():
     out(pins, 10)[31]
     set(pins, 3)
 
+def _make_xfer_prog(chips):
+    # the same program, but with one /WE line per chip
+    @asm_pio(out_init=(PIO.OUT_LOW,) * 8 + (PIO.OUT_HIGH,) * chips, out_shiftdir=PIO.SHIFT_RIGHT, set_init=(PIO.OUT_HIGH,) * chips)
+    def _xfer_prog_n():
+        pull()
+        out(pins, 8 + chips)[31]
+        set(pins, (1 << chips) - 1)
+    return _xfer_prog_n
+
 class Sound:
     BASE_PIN = 0
     CLOCK_PIN = 12
     CLOCK_FREQ = 1_200_000
+    CHIPS = 2
     LEFT = 0x200
     RIGHT = 0x100
 
-    def __init__(self, base_pin = BASE_PIN, clock_pin = CLOCK_PIN, clock_freq = CLOCK_FREQ):
+    def __init__(self, base_pin = BASE_PIN, clock_pin = CLOCK_PIN, clock_freq = CLOCK_FREQ, chips = CHIPS):
         self.base_pin = Pin(base_pin)
         self.we_pin = Pin(base_pin + 8)
         self.clock_pin = Pin(clock_pin)
         self.clock_freq = clock_freq
+        self.chips = chips
+        self.voices = 4 * chips
+        # selecting a chip means pulling its /WE low and leaving the others high
+        all_chips = (1 << chips) - 1
+        self.chip_select = [(all_chips ^ (1 << chip)) << 8 for chip in range(chips)]
+        # frequency writes held for flush(), room for one per voice
+        self.queue = array('I', [0] * (2 * self.voices))
+        self.queue_view = memoryview(self.queue)
+        self.queued = 0
+        # built once: a program object is loaded into PIO instruction memory each time it's new
+        self.xfer_prog = _xfer_prog if chips == 2 else _make_xfer_prog(chips)
 
         self._init_clock()
         self._init_xfer()
         self.silence()
 
     def set_frequency(self, voice, freq):
+        self.set_frequency_bytes(voice, freq & 0x0F, freq >> 4)
+
+    # low = bottom four bits of the frequency register, high = top six bits
+    def set_frequency_bytes(self, voice, low, high):
         channel, voice = self._unpack_voice(voice)
-        self._send_byte(channel, 0x80 | (voice << 5) | (freq & 0x0F))
-        self._send_byte(channel, freq >> 4)
+        self._send_byte(channel, 0x80 | (voice << 5) | low)
+        self._send_byte(channel, high)
+
+    def queue_frequency(self, voice, freq):
+        # like set_frequency, but held until flush() so several voices' writes go to the FIFO in one put
+        channel, voice = self._unpack_voice(voice)
+        n = self.queued
+        self.queue[n] = channel | 0x80 | (voice << 5) | (freq & 0x0F)
+        self.queue[n + 1] = channel | (freq >> 4)
+        self.queued = n + 2
+
+    def flush(self):
+        if self.queued:
+            self.xfer_sm.put(self.queue_view[:self.queued])
+            self.queued = 0
 
     def set_attenuation(self, voice, atten):
         channel, voice = self._unpack_voice(voice)
@@ -50,8 +91,20 @@ class Sound:
         channel, voice = self._unpack_voice(voice)
         self._send_byte(channel, 0xE0 | noise)
 
+    def set_clock(self, clock_freq):
+        # re-clocks the chips, and the transfer program, which times its writes in chip clocks.
+        # the writes already in the FIFO go out at the old clock first
+        if clock_freq == self.clock_freq:
+            return
+        while self.xfer_sm.tx_fifo():
+            pass
+        utime.sleep_us(32_000_000 // self.clock_freq + 1)  # the last write's 32 cycles
+        self.clock_freq = clock_freq
+        self._init_clock()
+        self._init_xfer()
+
     def silence(self):
-        for voice in range(8):
+        for voice in range(self.voices):
             self.set_attenuation(voice, 15)
 
     def shutdown(self):
@@ -60,10 +113,7 @@ class Sound:
         self._stop_clock()
 
     def _unpack_voice(self, voice):
-        if voice < 4:
-            return (Sound.LEFT, voice)
-        else:
-            return (Sound.RIGHT, voice - 4)
+        return (self.chip_select[voice >> 2], voice & 3)
 
     def _init_clock(self):
         self.clock_sm = StateMachine(0, _clock_prog, freq=self.clock_freq*2, set_base=self.clock_pin)
@@ -73,7 +123,7 @@ class Sound:
         self.clock_sm.active(0)
 
     def _init_xfer(self):
-        self.xfer_sm = StateMachine(1, _xfer_prog, freq=self.clock_freq, out_base=self.base_pin, set_base=self.we_pin)
+        self.xfer_sm = StateMachine(1, self.xfer_prog, freq=self.clock_freq, out_base=self.base_pin, set_base=self.we_pin)
         self.xfer_sm.active(1)
 
     def _stop_xfer(self):
@@ -0,0 +1,313 @@
+from argparse import ArgumentParser
+import asyncio
+import io
+import os
+import sys
+from pico_connection import find_pico_port, command_batches, PLAYER_SETUP, PLAYER_START, PLAYER_TEARDOWN
+from pyboard import PyboardError
+
+# asyncio counterparts of Pyboard and PicoConnection, so one process can convert the next song,
+# stream the current one and watch the Pico's output at the same time.
+#
+# devices are named like they are for Pyboard: a serial port (or pty), or exec:<command>
+# to talk to a process over its stdin/stdout.
+
+class DeviceOutput:
+    STDOUT = 'stdout'
+    STDERR = 'stderr'
+
+    def __init__(self, kind, data):
+        self.kind = kind
+        self.data = data
+
+    def __repr__(self):
+        return 'DeviceOutput({}, {!r})'.format(self.kind, self.data)
+
+class SerialTransport:
+    # a pyserial port watched with loop.add_reader, so reads never block the event loop
+    def __init__(self, device, baudrate=115200):
+        import serial
+        self.serial = serial.Serial(device, baudrate=baudrate, timeout=0)
+
+    async def start(self, on_data, on_close):
+        self.on_data = on_data
+        asyncio.get_running_loop().add_reader(self.serial.fileno(), self._readable)
+
+    def _readable(self):
+        data = self.serial.read(self.serial.in_waiting or 1)
+        if data:
+            self.on_data(data)
+
+    def write(self, data):
+        self.serial.write(data)
+
+    async def drain(self):
+        pass
+
+    async def close(self):
+        asyncio.get_running_loop().remove_reader(self.serial.fileno())
+        self.serial.close()
+
+class ProcessTransport:
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+    async def start(self, on_data, on_close):
+        self.proc = await asyncio.create_subprocess_shell(
+            self.cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, start_new_session=True)
+        self.reader = asyncio.ensure_future(self._pump(on_data, on_close))
+
+    async def _pump(self, on_data, on_close):
+        while True:
+            data = await self.proc.stdout.read(4096)
+            if not data:
+                on_close()
+                return
+            on_data(data)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    async def drain(self):
+        await self.proc.stdin.drain()
+
+    async def close(self):
+        self.reader.cancel()
+        if self.proc.returncode is None:
+            import signal
+            os.killpg(os.getpgid(self.proc.pid), signal.SIGTERM)
+            await self.proc.wait()
+
+class AsyncPyboard:
+    def __init__(self, device):
+        if device.startswith('exec:'):
+            self.transport = ProcessTransport(device[len('exec:'):])
+        else:
+            self.transport = SerialTransport(device)
+        self.rx_buf = bytearray()
+        self.rx_event = asyncio.Event()
+        self.closed = False
+        self.lock = asyncio.Lock()
+        self.listeners = []
+        self.use_raw_paste = True
+
+    async def open(self):
+        await self.transport.start(self._on_data, self._on_close)
+
+    async def close(self):
+        await self.transport.close()
+
+    def _on_data(self, data):
+        self.rx_buf.extend(data)
+        self.rx_event.set()
+
+    def _on_close(self):
+        self.closed = True
+        self.rx_event.set()
+
+    async def _wait_for_data(self):
+        if self.closed:
+            raise PyboardError('device closed the connection')
+        self.rx_event.clear()
+        await self.rx_event.wait()
+
+    async def _write(self, data):
+        self.transport.write(data)
+        await self.transport.drain()
+
+    async def _read(self, size):
+        while len(self.rx_buf) < size:
+            await self._wait_for_data()
+        data = bytes(self.rx_buf[:size])
+        del self.rx_buf[:size]
+        return data
+
+    async def read_until(self, ending, timeout=10, data_consumer=None):
+        # data_consumer sees the data as it arrives, not including the ending
+        async def scan():
+            scan_from = 0
+            while True:
+                end = self.rx_buf.find(ending, scan_from)
+                if end >= 0:
+                    data = bytes(self.rx_buf[:end])
+                    del self.rx_buf[:end + len(ending)]
+                    if data_consumer and data[scan_from:]:
+                        data_consumer(data[scan_from:])
+                    return data + ending
+                safe = max(scan_from, len(self.rx_buf) - len(ending) + 1)
+                if data_consumer and safe > scan_from:
+                    data_consumer(bytes(self.rx_buf[scan_from:safe]))
+                scan_from = safe
+                await self._wait_for_data()
+        try:
+            return await asyncio.wait_for(scan(), timeout)
+        except asyncio.TimeoutError:
+            raise PyboardError('timeout waiting for {!r}'.format(ending))
+
+    def output_events(self):
+        # an async iterator of DeviceOutput events, for as long as the caller keeps iterating
+        queue = asyncio.Queue()
+        self.listeners.append(queue)
+        async def events():
+            try:
+                while True:
+                    yield await queue.get()
+            finally:
+                self.listeners.remove(queue)
+        return events()
+
+    def _emit(self, kind, data):
+        for queue in self.listeners:
+            queue.put_nowait(DeviceOutput(kind, data))
+
+    async def enter_raw_repl(self):
+        await self._write(b'\r\x03\x03')  # ctrl-C twice: interrupt any running program
+        await asyncio.sleep(0.1)
+        del self.rx_buf[:]
+
+        await self._write(b'\r\x01')  # ctrl-A: enter raw REPL
+        await self.read_until(b'raw REPL; CTRL-B to exit\r\n>')
+        await self._write(b'\x04')  # ctrl-D: soft reset
+        await self.read_until(b'soft reboot\r\n')
+        await self.read_until(b'raw REPL; CTRL-B to exit\r\n')
+
+    async def exit_raw_repl(self):
+        await self._write(b'\r\x02')  # ctrl-B: enter friendly REPL
+
+    async def _raw_paste_write(self, command_bytes):
+        data = await self._read(2)
+        window_size = data[0] | data[1] << 8
+        window_remain = window_size
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or self.rx_buf:
+                data = await self._read(1)
+                if data == b'\x01':
+                    window_remain += window_size
+                elif data == b'\x04':
+                    await self._write(b'\x04')
+                    return
+                else:
+                    raise PyboardError('unexpected read during raw paste: {}'.format(data))
+            b = command_bytes[i:i + window_remain]
+            await self._write(b)
+            window_remain -= len(b)
+            i += len(b)
+        await self._write(b'\x04')
+        await self.read_until(b'\x04')
+
+    async def exec_raw_no_follow(self, command):
+        command_bytes = command if isinstance(command, bytes) else command.encode('utf8')
+        await self.read_until(b'>')
+
+        if self.use_raw_paste:
+            await self._write(b'\x05A\x01')
+            data = await self._read(2)
+            if data == b'R\x01':
+                return await self._raw_paste_write(command_bytes)
+            if data != b'R\x00':
+                await self.read_until(b'w REPL; CTRL-B to exit\r\n>')
+            self.use_raw_paste = False
+
+        for i in range(0, len(command_bytes), 256):
+            await self._write(command_bytes[i:i + 256])
+            await asyncio.sleep(0.01)
+        await self._write(b'\x04')
+        data = await self._read(2)
+        if data != b'OK':
+            raise PyboardError('could not exec command (response: {!r})'.format(data))
+
+    async def follow(self, timeout=10):
+        out = await self.read_until(b'\x04', timeout, lambda d: self._emit(DeviceOutput.STDOUT, d))
+        err = await self.read_until(b'\x04', timeout, lambda d: self._emit(DeviceOutput.STDERR, d))
+        return out[:-1], err[:-1]
+
+    async def exec(self, command, timeout=10):
+        async with self.lock:
+            await self.exec_raw_no_follow(command)
+            out, err = await self.follow(timeout)
+        if err:
+            raise PyboardError('exception', out, err)
+        return out
+
+class AsyncPicoConnection:
+    def __init__(self, device=None):
+        self.pyboard = AsyncPyboard(device or find_pico_port())
+
+    async def open(self):
+        await self.pyboard.open()
+
+    async def close(self):
+        await self.pyboard.close()
+
+    async def exec(self, command, timeout=10):
+        return await self.pyboard.exec(command, timeout)
+
+    def output_events(self):
+        return self.pyboard.output_events()
+
+    async def _send_command_queue(self, commands):
+        await self.pyboard.exec(f't=m.play_words({commands},t)\r\n', timeout=None)
+
+    async def play_song(self, buf):
+        try:
+            await self.pyboard.enter_raw_repl()
+            for command in PLAYER_SETUP:
+                await self.pyboard.exec(command)
+            await self.pyboard.exec(PLAYER_START)
+            for command_queue in command_batches(buf):
+                await self._send_command_queue(command_queue)
+            await self.pyboard.exec(PLAYER_TEARDOWN)
+        except asyncio.CancelledError:
+            # force a Ctrl+C to be sent to the Pico
+            await self.pyboard.enter_raw_repl()
+            raise
+        finally:
+            await self.pyboard.exit_raw_repl()
+
+# example controller: converts each song while the previous one plays, and echoes device output
+
+def _convert(filename):
+    from mido import MidiFile
+    import convert_midi
+    encoder = convert_midi.convert(MidiFile(filename), name=filename)
+    buf = io.BytesIO()
+    encoder.write_output(buf)
+    buf.seek(0, io.SEEK_SET)
+    return buf
+
+async def _monitor(connection):
+    async for event in connection.output_events():
+        stream = sys.stdout if event.kind == DeviceOutput.STDOUT else sys.stderr
+        stream.write(event.data.decode('utf8', 'replace'))
+        stream.flush()
+
+async def play_files(filenames, device=None):
+    loop = asyncio.get_running_loop()
+    connection = AsyncPicoConnection(device)
+    await connection.open()
+    monitor = asyncio.ensure_future(_monitor(connection))
+    try:
+        upcoming = loop.run_in_executor(None, _convert, filenames[0])
+        for i, filename in enumerate(filenames):
+            buf = await upcoming
+            if i + 1 < len(filenames):
+                upcoming = loop.run_in_executor(None, _convert, filenames[i + 1])
+            print('playing {}'.format(filename))
+            await connection.play_song(buf)
+    finally:
+        monitor.cancel()
+        await connection.close()
+
+def main():
+    parser = ArgumentParser(description='Play MIDI files on the Pico, converting each one while the previous one plays')
+    parser.add_argument('infiles', type=str, nargs='+', help='input midi files')
+    parser.add_argument('-d', '--device', type=str, help='serial device, pty or exec:<command> (default: find the Pico)')
+    args = parser.parse_args()
+    try:
+        asyncio.run(play_files(args.infiles, args.device))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+from argparse import ArgumentParser
+from mido import MidiFile
+import contextlib
+import io
+import time
+import tracemalloc
+import convert_midi
+import synthetic_midi
+
+# measures convert_midi.py throughput, one stage at a time:
+#   parse  - mido reading the MIDI file
+#   log    - the track analysis, Encoder.log_* for every message and the loudness analysis
+#   write  - Encoder.write_output (voice allocation and word encoding)
+
+class Sample:
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+def _midi_bytes(midi):
+    buf = io.BytesIO()
+    midi.save(file=buf)
+    return buf.getvalue()
+
+def _parse(sample):
+    return MidiFile(file=io.BytesIO(sample.data))
+
+def _log(midi):
+    # the melody heuristic prints what it finds; that's noise here
+    with contextlib.redirect_stdout(io.StringIO()):
+        return convert_midi.convert(midi)
+
+def _write(encoder):
+    out = io.BytesIO()
+    encoder.write_output(out)
+    return out
+
+def _time(fn, arg, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def _peak_memory(fn, arg):
+    tracemalloc.start()
+    try:
+        fn(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_sample(sample, repeat):
+    parse_time, midi = _time(_parse, sample, repeat)
+    messages = sum(len(track) for track in midi.tracks)
+
+    # log_* mutates the encoder, so every repetition needs a fresh one
+    log_time, encoder = _time(_log, midi, repeat)
+    events = len(encoder.events)
+
+    # write_output mutates voice state as well; rebuild the encoder for each run outside the timed region
+    write_time = None
+    for _ in range(repeat):
+        encoder = _log(midi)
+        elapsed, out = _time(_write, encoder, 1)
+        if write_time is None or elapsed < write_time:
+            write_time = elapsed
+    words = len(out.getvalue()) // 2
+
+    return [
+        ('parse', messages, 'msgs', parse_time, _peak_memory(_parse, sample)),
+        ('log', messages, 'msgs', log_time, _peak_memory(_log, midi)),
+        ('write', events, 'events', write_time, _peak_memory(_write, _log(midi))),
+        ('(output)', words, 'words', None, None),
+    ]
+
+def _rate(count, seconds):
+    if not seconds:
+        return ''
+    return '{:,.0f}/s'.format(count / seconds)
+
+def print_report(sample, rows):
+    print(sample.name)
+    for stage, count, unit, seconds, peak in rows:
+        if seconds is None:
+            print('  {:<8} {:>9,} {:<6}'.format(stage, count, unit))
+        else:
+            print('  {:<8} {:>9,} {:<6} {:>9.1f} ms {:>14} peak {:>9,.0f} KiB'.format(
+                stage, count, unit, seconds * 1000, _rate(count, seconds), peak / 1024))
+
+def synthetic_samples(generators, sizes, seed):
+    for name in generators:
+        for beats in sizes:
+            midi = synthetic_midi.GENERATORS[name](beats=beats, seed=seed)
+            yield Sample('{} ({} beats)'.format(name, beats), _midi_bytes(midi))
+
+def main():
+    parser = ArgumentParser(description='Benchmark convert_midi.py stages on synthetic or real MIDI files')
+    parser.add_argument('files', type=str, nargs='*', help='additional MIDI files to benchmark')
+    parser.add_argument('-g', '--generators', type=str, nargs='*', choices=sorted(synthetic_midi.GENERATORS),
+                        default=sorted(synthetic_midi.GENERATORS), help='synthetic workloads to run')
+    parser.add_argument('-b', '--beats', type=int, nargs='*', default=[64, 512],
+                        help='synthetic song lengths, in beats')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per stage; the best time is reported')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='random seed for the synthetic generators')
+    args = parser.parse_args()
+
+    samples = list(synthetic_samples(args.generators, args.beats, args.seed))
+    for filename in args.files:
+        with open(filename, 'rb') as f:
+            samples.append(Sample(filename, f.read()))
+
+    for sample in samples:
+        print_report(sample, run_sample(sample, args.repeat))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+from argparse import ArgumentParser
+import statistics
+import time
+from pico_connection import find_pico_port
+from pyboard import Pyboard
+
+# measures raw-REPL round-trip latency (one exec of a trivial statement, like each batch
+# PicoConnection streams), with the current Pyboard.read_until and with the old polling one
+
+def polling_read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None):
+    # Pyboard.read_until as it was: one byte per read, sleeping 10 ms whenever nothing is waiting
+    assert data_consumer is None or len(ending) == 1
+
+    data = self.serial.read(min_num_bytes)
+    if data_consumer:
+        data_consumer(data)
+    timeout_count = 0
+    while True:
+        if data.endswith(ending):
+            break
+        elif self.serial.inWaiting() > 0:
+            new_data = self.serial.read(1)
+            if data_consumer:
+                data_consumer(new_data)
+                data = new_data
+            else:
+                data = data + new_data
+            timeout_count = 0
+        else:
+            timeout_count += 1
+            if timeout is not None and timeout_count >= 100 * timeout:
+                break
+            time.sleep(0.01)
+    return data
+
+def measure(device, count, command):
+    pyboard = Pyboard(device)
+    try:
+        pyboard.enter_raw_repl()
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            pyboard.exec_(command)
+            samples.append(time.perf_counter() - start)
+        pyboard.exit_raw_repl()
+        return samples
+    finally:
+        pyboard.close()
+
+def report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print('{:<8} min {:7.2f} ms  median {:7.2f} ms  p95 {:7.2f} ms  max {:7.2f} ms'.format(
+        label, samples[0] * 1000, statistics.median(samples) * 1000, p95 * 1000, samples[-1] * 1000))
+
+def main():
+    parser = ArgumentParser(description='Measure raw REPL round-trip latency before and after event-driven reads')
+    parser.add_argument('-d', '--device', type=str, help='serial device or other Pyboard device string (default: find the Pico)')
+    parser.add_argument('-n', '--count', type=int, default=200, help='round trips per measurement')
+    parser.add_argument('-c', '--command', type=str, default='pass', help='statement to execute each round trip')
+    args = parser.parse_args()
+
+    device = args.device or find_pico_port()
+    current = Pyboard.read_until
+    Pyboard.read_until = polling_read_until
+    try:
+        report('polling', measure(device, args.count, args.command))
+    finally:
+        Pyboard.read_until = current
+    report('select', measure(device, args.count, args.command))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+from argparse import ArgumentParser
+import contextlib
+import io
+import os
+import shlex
+import sys
+import tempfile
+import time
+import numpy as np
+from mido import MidiFile
+import convert_midi
+import song_words
+from bench_repl import report
+from pico_connection import PicoConnection
+from pico_sim import TICKS_PERIOD, ticks_diff
+
+# streams a song the way convert_midi.py does and measures how well the stream keeps up: by default
+# to pico_sim.py, whose log of every word played gives how late each note was and how long each batch
+# took from being sent to being played. the simulator's ticks are the host's monotonic clock, so the
+# two can be compared directly. a real Pico (-d) only gives the round trip of each batch.
+
+SIM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pico_sim.py')
+LATE_US = 1000  # notes played later than this count as underruns
+
+def load_song(filename, seconds=None):
+    if filename.endswith('.mid'):
+        with contextlib.redirect_stdout(io.StringIO()):
+            encoder = convert_midi.convert(MidiFile(filename), name=filename)
+        buf = io.BytesIO()
+        encoder.write_output(buf)
+        words = song_words.load(buf.getvalue())
+    else:
+        words = song_words.load(filename)
+    if seconds is not None:
+        words = words[:np.searchsorted(song_words.timestamps_us(words), seconds * 1_000_000, side='right')]
+    return words
+
+def stream(words, device):
+    # returns [(monotonic time the batch started sending, seconds until its exec returned, words, bytes sent)]
+    connection = PicoConnection(device)
+    serial = connection.pyboard.serial
+    sent = [0]
+    write = serial.write
+    def counted_write(data):
+        sent[0] += len(data)
+        return write(data)
+    serial.write = counted_write
+
+    batches = []
+    send = connection._send_command_queue
+    def timed_send(commands):
+        start, before = time.monotonic(), sent[0]
+        send(commands)
+        batches.append((start, time.monotonic() - start, len(commands), sent[0] - before))
+    connection._send_command_queue = timed_send
+    try:
+        connection.play_song(io.BytesIO(words.tobytes()))
+    finally:
+        connection.pyboard.close()
+    return batches
+
+def read_log(path):
+    # (ticks_us when played, cmd_time it was due, word) for every word, as columns
+    log = np.loadtxt(path, dtype=np.int64, ndmin=2)
+    return log[:, 0], log[:, 1], log[:, 2]
+
+def report_log(batches, log):
+    played, due, words = log
+    if len(words) != sum(batch[2] for batch in batches):
+        print('the log has {} words, but {} were sent'.format(len(words), sum(batch[2] for batch in batches)))
+        return
+    firsts = np.cumsum([0] + [batch[2] for batch in batches[:-1]])
+    sent_ticks = np.array([round(batch[0] * 1_000_000) for batch in batches]) % TICKS_PERIOD
+    latency = ticks_diff(played[firsts], sent_ticks)
+    report('latency', latency / 1e6)
+    print('         (from sending a batch to its first word playing)')
+    sending = sum(batch[3] for batch in batches)
+    print('{:.1f} kB/s while batches were in flight'.format(sending / latency.sum() * 1e6 / 1000))
+
+    # a delay can start late without harm; what's heard is when everything else happens
+    late = ticks_diff(played, due)[~song_words.is_delay(words.astype(np.uint16))]
+    report('late', late / 1e6)
+    underruns = late > LATE_US
+    print('{} of {} commands more than {:.1f} ms late'.format(underruns.sum(), len(late), LATE_US / 1000))
+
+def main():
+    parser = ArgumentParser(description='Measure streaming throughput, latency and underruns to the Pico or a simulated one')
+    parser.add_argument('song', type=str, help='MIDI file (.mid) or song file from convert_midi.py')
+    parser.add_argument('-d', '--device', type=str,
+                        help='serial device or other Pyboard device string (default: run pico_sim.py)')
+    parser.add_argument('-s', '--seconds', type=float, help='only stream the song\'s first SECONDS')
+    parser.add_argument('--bandwidth', type=int, default=1_000_000, help='simulated USB bandwidth, in bytes per second')
+    parser.add_argument('--frame-us', type=int, default=1000, help='simulated USB frame length in microseconds')
+    args = parser.parse_args()
+
+    words = load_song(args.song, args.seconds)
+    song_time = song_words.timestamps_us(words)[-1] / 1e6 if len(words) else 0
+    log_path = None
+    device = args.device
+    if not device:
+        fd, log_path = tempfile.mkstemp(prefix='bench_stream_', suffix='.log')
+        os.close(fd)
+        device = 'exec:{} {} --log {} --bandwidth {} --frame-us {}'.format(
+            shlex.quote(sys.executable), shlex.quote(SIM), shlex.quote(log_path), args.bandwidth, args.frame_us)
+
+    try:
+        start = time.monotonic()
+        batches = stream(words, device)
+        elapsed = time.monotonic() - start
+        print('{}: {} words in {} batches, {:.1f} s of music, streamed in {:.1f} s ({} bytes sent)'.format(
+            args.song, len(words), len(batches), song_time, elapsed, sum(batch[3] for batch in batches)))
+        report('exec', [batch[1] for batch in batches])
+        if log_path:
+            report_log(batches, read_log(log_path))
+    finally:
+        if log_path:
+            os.remove(log_path)
+
+if __name__ == '__main__':
+    main()
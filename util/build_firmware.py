@@ -0,0 +1,130 @@
+from argparse import ArgumentParser
+import importlib.util
+import math
+import os
+import re
+import shutil
+import subprocess
+
+# build step for the firmware:
+#  * generates firmware/frequency_table.py, so MusicPlayer doesn't have to compute
+#    the note and fine-tuning tables with floating point math every time it starts up
+#  * optionally precompiles the firmware to .mpy bytecode with mpy-cross, so the Pico
+#    doesn't have to compile it from source on every import
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRMWARE_DIR = os.path.join(ROOT, 'firmware')
+BUILD_DIR = os.path.join(ROOT, 'build', 'firmware')
+TABLE_MODULE = 'frequency_table.py'
+FINE_STEPS = 16     # steps per semitone for pitch bends and vibrato
+FINE_BITS = 6       # extra bits of precision in the fine-tuning table
+
+# the Pico runs these by name, so they have to stay source files
+SOURCE_ONLY = ['boot.py', 'main.py']
+
+def sound_clock_freq():
+    # the default clock from firmware/sound.py; it imports rp2, so it can't simply be imported here
+    with open(os.path.join(FIRMWARE_DIR, 'sound.py')) as f:
+        m = re.search(r'^\s*CLOCK_FREQ\s*=\s*([0-9_]+)', f.read(), re.M)
+    return int(m.group(1))
+
+def _envelopes():
+    # firmware/envelopes.py is plain data, so unlike sound.py it can be loaded as it is
+    spec = importlib.util.spec_from_file_location('envelopes', os.path.join(FIRMWARE_DIR, 'envelopes.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def envelope_profiles():
+    module = _envelopes()
+    return module.PROFILES, module.INSTANT
+
+def vibrato_wave():
+    return _envelopes().VIBRATO_WAVE
+
+def frequency_table(clock_freq):
+    # the value of the 10-bit frequency register for each MIDI note
+    table = []
+    n = clock_freq / (32 * 440)
+    for midi_note in range(128):
+        f = n / math.pow(2, (midi_note - 69.0) / 12)
+        while f > 1023:
+            f /= 2  # shift notes that won't fit into the frequency register up an octave until they do
+        table.append(round(f))
+    return table
+
+def fine_table(clock_freq):
+    # returns (base, table): the frequency register, times 2^FINE_BITS, for each fine step of the lowest
+    # octave that fits in 10 bits, starting base fine steps above MIDI note 0. every other pitch is an
+    # entry shifted right by its octaves above that (lower pitches are folded up, like the note table),
+    # so MusicPlayer can bend notes with integer math
+    octave = 12 * FINE_STEPS
+    n = clock_freq / (32 * 440)
+    def period(step):
+        return n / math.pow(2, (step / FINE_STEPS - 69.0) / 12)
+    base = 0
+    while period(base) > 1023:
+        base += 1
+    return base, [round(period(base + step) * (1 << FINE_BITS)) for step in range(octave)]
+
+def fine_period(base, table, note, offset):
+    # the frequency register for note bent by offset fine steps, as MusicPlayer works it out
+    octave = 12 * FINE_STEPS
+    step = note * FINE_STEPS + offset - base
+    shift = FINE_BITS + max(step, 0) // octave
+    return (table[step % octave] + (1 << (shift - 1))) >> shift
+
+def generate_table_module(clock_freq, path):
+    table = frequency_table(clock_freq)
+    # split the way Sound sends them: the low four bits go in the latch byte, the high six in the data byte
+    low = bytes(freq & 0x0F for freq in table)
+    high = bytes(freq >> 4 for freq in table)
+    fine_base, fine = fine_table(clock_freq)
+    with open(path, 'w') as f:
+        f.write('# generated by util/build_firmware.py; do not edit\n')
+        f.write('from array import array\n')
+        f.write('CLOCK_FREQ = {}\n'.format(clock_freq))
+        f.write('LOW = {!r}\n'.format(low))
+        f.write('HIGH = {!r}\n'.format(high))
+        f.write('FINE_BASE = {}\n'.format(fine_base))
+        f.write('FINE = array(\'H\', {!r})\n'.format(fine))
+
+def compile_mpy(mpy_cross, src_dir, dest_dir):
+    # returns the files to deploy: .mpy for modules, plus anything that has to stay source
+    if not shutil.which(mpy_cross):
+        raise RuntimeError('{} not found; install it with e.g. pip install mpy-cross'.format(mpy_cross))
+    os.makedirs(dest_dir, exist_ok=True)
+    outputs = []
+    for name in sorted(os.listdir(src_dir)):
+        src = os.path.join(src_dir, name)
+        if not name.endswith('.py'):
+            continue
+        if name in SOURCE_ONLY:
+            dest = os.path.join(dest_dir, name)
+            shutil.copyfile(src, dest)
+        else:
+            dest = os.path.join(dest_dir, name[:-3] + '.mpy')
+            subprocess.run([mpy_cross, '-o', dest, '-s', name, src], check=True)
+        outputs.append(dest)
+    return outputs
+
+def build(clock_freq=None, mpy=False, mpy_cross='mpy-cross'):
+    if clock_freq is None:
+        clock_freq = sound_clock_freq()
+    generate_table_module(clock_freq, os.path.join(FIRMWARE_DIR, TABLE_MODULE))
+    if mpy:
+        return compile_mpy(mpy_cross, FIRMWARE_DIR, BUILD_DIR)
+    return [os.path.join(FIRMWARE_DIR, name) for name in sorted(os.listdir(FIRMWARE_DIR)) if name.endswith('.py')]
+
+def main():
+    parser = ArgumentParser(description='Generate firmware tables and optionally precompile the firmware')
+    parser.add_argument('--clock', type=int, help='sound chip clock in Hz (default: Sound.CLOCK_FREQ)')
+    parser.add_argument('--mpy', action='store_true', help='precompile the firmware to .mpy files in build/firmware')
+    parser.add_argument('--mpy-cross', type=str, default='mpy-cross', help='path to the mpy-cross compiler')
+    args = parser.parse_args()
+
+    for path in build(args.clock, args.mpy, args.mpy_cross):
+        print(os.path.relpath(path, ROOT))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+from argparse import ArgumentParser
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter
+import convert_midi
+import decode_dat
+import multi_pico
+import pico_sim
+import song_words
+import synthetic_midi
+import tracks
+
+# converts a corpus of generated MIDI files and compares the output word streams against
+# recorded goldens, so encoder changes can be verified byte-identical.
+# run with --record after an intentional change to the output format.
+# checking the whole corpus also checks that a song split across boards keeps its balance, and that
+# the Pico's song index only offers a player the goldens it has the chips for.
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'goldens')
+
+# name, generator, generator arguments, convert arguments
+CORPUS = [
+    ('many_channels', 'many_channels', {'beats': 96, 'seed': 1}, {}),
+    ('many_channels_dense', 'many_channels', {'beats': 64, 'channels': 15, 'density': 8, 'seed': 2}, {}),
+    ('many_channels_priority', 'many_channels', {'beats': 64, 'seed': 3},
+        {'prioritize_channels': [2, 3], 'exclude_channels': [5]}),
+    ('percussion_heavy', 'percussion_heavy', {'beats': 96, 'seed': 1}, {}),
+    ('sustained_chords', 'sustained_chords', {'beats': 96, 'seed': 1}, {}),
+    ('tempo_changes', 'tempo_changes', {'beats': 96, 'seed': 1}, {}),
+    ('many_channels_lookahead', 'many_channels', {'beats': 64, 'channels': 15, 'density': 8, 'seed': 2},
+        {'lookahead': True}),
+    ('many_channels_4_chips', 'many_channels', {'beats': 64, 'channels': 15, 'density': 8, 'seed': 2}, {'chips': 4}),
+    ('expressive', 'expressive', {'beats': 64, 'seed': 1}, {}),
+    ('controls_between_notes', 'controls_between_notes', {'beats': 32, 'seed': 1}, {}),
+]
+
+def convert_entry(generator, generator_args, convert_args):
+    midi = synthetic_midi.GENERATORS[generator](**generator_args)
+    with contextlib.redirect_stdout(io.StringIO()):
+        encoder = convert_midi.convert(midi, **convert_args)
+    out = io.BytesIO()
+    encoder.write_output(out)
+    return out.getvalue()
+
+def golden_path(name):
+    return os.path.join(GOLDEN_DIR, name + '.dat')
+
+def _words(data):
+    return decode_dat.read_words(data)
+
+def first_difference(expected, actual):
+    common = min(len(expected), len(actual))
+    differences = (expected[:common] != actual[:common]).nonzero()[0]
+    if len(differences):
+        return int(differences[0])
+    if len(expected) != len(actual):
+        return common
+    return None
+
+def print_context(label, words, index, context):
+    print('  {}:'.format(label))
+    window = range(max(0, index - context), min(len(words), index + context + 1))
+    for i, ms, command in decode_dat.timeline(words, window):
+        marker = '>' if i == index else ' '
+        print('  {} {}'.format(marker, decode_dat.format_line(i, ms, command)))
+
+def check(name, data, context):
+    path = golden_path(name)
+    if not os.path.exists(path):
+        print('{}: MISSING golden (run with --record)'.format(name))
+        return False
+    with open(path, 'rb') as f:
+        golden = f.read()
+    if golden == data:
+        print('{}: ok ({} words)'.format(name, len(data) // 2))
+        return True
+
+    expected, actual = _words(golden), _words(data)
+    index = first_difference(expected, actual)
+    print('{}: MISMATCH at word {} (golden {} words, now {} words)'.format(name, index, len(expected), len(actual)))
+    print_context('golden', expected, index, context)
+    print_context('actual', actual, index, context)
+    return False
+
+def _note_attenuations(encoder):
+    return Counter((note.timestamp, note.channel, note.midi_note, note.atten) for note in encoder.logged_notes)
+
+def check_split_loudness(boards=3):
+    # each board's share of a song split by multi_pico.py plays its notes as loud as the whole song does
+    midi = synthetic_midi.GENERATORS['many_channels'](beats=64, seed=4)
+    track_stats = tracks.analyze(midi)
+    assignments, all_channels = multi_pico.partition_channels(track_stats, boards)
+    with contextlib.redirect_stdout(io.StringIO()):
+        whole = _note_attenuations(convert_midi.convert(midi, track_stats=track_stats))
+        shares = [_note_attenuations(convert_midi.convert(midi, exclude_channels=all_channels - channels,
+                                                          track_stats=track_stats))
+                  for channels in assignments]
+    ok = True
+    for board, share in enumerate(shares):
+        different = share - whole
+        if not share or different:
+            print('split loudness: board {} has {} of {} notes at a different attenuation'.format(
+                board, sum(different.values()), sum(share.values())))
+            ok = False
+    if ok:
+        print('split loudness: ok ({} boards)'.format(boards))
+    return ok
+
+def check_song_index(chips=3):
+    # firmware/song_index.py over a copy of the goldens, on the host with pico_sim's stand-in modules:
+    # every song it counts as playable has to play on a player with this many chips
+    pico_sim.install_modules()
+    if pico_sim.FIRMWARE_DIR not in sys.path:
+        sys.path.append(pico_sim.FIRMWARE_DIR)
+    from music_player import MusicPlayer
+    from song_index import SongIndex
+    player = MusicPlayer(chips=chips)
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        for name, _, _, _ in CORPUS:
+            shutil.copy(golden_path(name), directory)
+        playable = SongIndex(directory).update().playable(player.voices)
+        for name, _, _, _ in CORPUS:
+            path = os.path.join(directory, name + '.dat')
+            words = song_words.load(path)
+            voices = 1 + max((command.voice for _, _, command in decode_dat.timeline(words)
+                              if command.kind in (decode_dat.NOTE_ON, decode_dat.NOISE_ON)), default=-1)
+            if (voices <= player.voices) != (path in playable):
+                print('song index: {} ({} voices) {} offered to a {}-chip player'.format(
+                    name, voices, 'wrongly' if path in playable else 'not', chips))
+                ok = False
+            elif path in playable:
+                player._reset_voices()
+                for word in words[~song_words.is_delay(words)].tolist():    # delays would only take time
+                    player.play_word(word, 0)
+        del words   # the memory map, before its directory goes
+    player.finish_playing()
+    if ok:
+        print('song index: ok ({} of {} songs for {} chips)'.format(len(playable), len(CORPUS), chips))
+    return ok
+
+def main():
+    parser = ArgumentParser(description='Compare convert_midi.py output against recorded goldens')
+    parser.add_argument('names', type=str, nargs='*', help='corpus entries to check (default: all)')
+    parser.add_argument('--record', action='store_true', help='overwrite the goldens with the current output')
+    parser.add_argument('--timeline', action='store_true', help='print the decoded timeline of the current output')
+    parser.add_argument('-C', '--context', type=int, default=5, help='words of context to show around a mismatch')
+    args = parser.parse_args()
+
+    entries = [entry for entry in CORPUS if not args.names or entry[0] in args.names]
+    ok = True
+    for name, generator, generator_args, convert_args in entries:
+        data = convert_entry(generator, generator_args, convert_args)
+        if args.timeline:
+            print(name)
+            for index, ms, command in decode_dat.timeline(_words(data)):
+                print(decode_dat.format_line(index, ms, command))
+        elif args.record:
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            with open(golden_path(name), 'wb') as f:
+                f.write(data)
+            print('{}: recorded ({} words)'.format(name, len(data) // 2))
+        else:
+            ok = check(name, data, args.context) and ok
+    if not args.names and not args.record and not args.timeline:
+        ok = check_split_loudness() and ok
+        ok = check_song_index() and ok
+
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,25 @@
 from argparse import ArgumentParser
-from mido import MidiFile
-import re
+from mido import MidiFile, merge_tracks
 import io
+import numpy as np
+import loudness
+import percussion
+import tracks
+import tuning
 from pico_connection import PicoConnection
 
-parser = ArgumentParser(description='Convert MIDI file for pico_player')
-parser.add_argument('infile', type=str, help='input midi file')
-parser.add_argument('-p', '--prioritize-channels', type=int, metavar='CHANNEL', nargs='*',
-                    help='give specific channels priority when filling voices')
-parser.add_argument('-x', '--exclude-channels', type=int, metavar='CHANNEL', nargs='*',
-                    help='exclude certain channels from the output file')
-parser.add_argument('outfile', type=str, help='output binary file, or use - to stream to the Pico')
-args = parser.parse_args()
-
 class Note:
-    def __init__(self, midi_note, channel, velocity=0, timestamp=0):
+    def __init__(self, midi_note, channel, atten=0, timestamp=0, envelope=0, bend=0, vibrato=0):
         self.midi_note = midi_note
         self.channel = channel
-        self.velocity = velocity
+        self.atten = atten
         self.timestamp = timestamp
+        self.envelope = envelope
+        self.bend = bend
+        self.vibrato = vibrato
+        self.planned_voice = None
+
+# all times here are integer microseconds since the start of the song
 
 class Event:
     def __init__(self, delay, previous_timestamp):
@@ -27,29 +28,55 @@ class Event:
         self.notes_on = []
         self.notes_off = []
         self.percussion = []
+        self.pitch_changes = []     # (channel, bend, vibrato)
 
     def merge(self, prior_note_off_event):
-        if prior_note_off_event.notes_on or prior_note_off_event.percussion:
+        if prior_note_off_event.notes_on or prior_note_off_event.percussion or prior_note_off_event.pitch_changes:
             raise RuntimeError('invalid merge')
         self.delay += prior_note_off_event.delay
         self.notes_off.extend(prior_note_off_event.notes_off)
 
 class Encoder:
-    def __init__(self, all_channels, priority_channels, max_velocity):
-        self.notes_playing = [Note(None, None)] * 6
+    def __init__(self, all_channels, priority_channels, chips=2, lookahead=False, kit=None):
+        self.chips = chips
+        self.lookahead = lookahead
+        self.voices = 3 * chips     # tonal voices; each chip's fourth channel is noise
+        self.notes_playing = [Note(None, None)] * self.voices
+        self.channel_envelopes = {}     # the envelope profile for each channel's current program
+        self.voice_envelopes = [0] * self.voices
+        self.channel_pitch = {}     # (bend, vibrato) in fine steps, for each channel
+        self.bend_ranges = {}       # semitones, for channels that set their own with RPN 0
+        self.rpn = {}               # the registered parameter each channel's data entry goes to
+        self.voice_bends = [0] * self.voices
+        self.voice_vibratos = [0] * self.voices
+        self.bank = 0
+        self.written_time = 0   # song time up to which delays have been written
         self.events = []
         self.priority_channels = priority_channels
-        self.velocity_adjustment = 127 - max_velocity
+        self.velocity_attenuation = loudness.velocity_table()   # until analyze_loudness has seen the whole song
+        self.logged_notes = []      # every note-on logged, and its velocity, for analyze_loudness
+        self.logged_velocities = []
+        self.song_times = []        # and of every note-on in the song, on excluded channels too
+        self.song_velocities = []
+        self.percussion_tables = percussion.compile_kit(kit or percussion.DEFAULT_KIT)
+        self.tuning = None          # the chips' clock for the song's clock command, from choose_clock
+        self.default_tuning = None
         self.include_percussion = False
+        self.dropped_notes = 0
+        self.preempted_notes = 0
         self._assign_preferred_chip(all_channels)
 
     def log_delay(self, delay):
-        if self.events and not self.events[-1].notes_on and not self.events[-1].notes_off and not self.events[-1].percussion:
-            self.events[-1].delay += delay
+        last = self.events[-1] if self.events else None
+        if last and not last.notes_on and not last.notes_off and not last.percussion and not last.pitch_changes:
+            last.delay += delay
+            last.timestamp += delay
         else:
             self.events.append(Event(delay, self._previous_timestamp()))
 
     def log_note_on(self, note, channel, velocity):
+        self.song_times.append(self._previous_timestamp())
+        self.song_velocities.append(velocity)
         if channel == 10:
             if not self.include_percussion:
                 return
@@ -57,10 +84,17 @@ class Encoder:
             if channel not in self.preferred_chip:
                 return
         event = self._ensure_event()
+        atten = self.velocity_attenuation[velocity]
         if channel == 10:
-            event.percussion.append(Note(note, channel, velocity))
+            logged = Note(note, channel, atten, timestamp=event.timestamp)
+            event.percussion.append(logged)
         else:
-            event.notes_on.append(Note(note, channel, velocity, timestamp=event.timestamp))
+            bend, vibrato = self.channel_pitch.get(channel, (0, 0))
+            logged = Note(note, channel, atten, timestamp=event.timestamp,
+                          envelope=self.channel_envelopes.get(channel, 0), bend=bend, vibrato=vibrato)
+            event.notes_on.append(logged)
+        self.logged_notes.append(logged)
+        self.logged_velocities.append(velocity)
 
     def log_note_off(self, note, channel):
         if channel not in self.preferred_chip:
@@ -68,21 +102,72 @@ class Encoder:
         event = self._ensure_event()
         event.notes_off.append(Note(note, channel, timestamp=event.timestamp))
 
+    def log_program_change(self, channel, program):
+        if channel != 10:
+            self.channel_envelopes[channel] = self.PROGRAM_ENVELOPES[program // 8]
+
+    def log_pitch_bend(self, channel, pitch):
+        # pitch is -8192 to 8191, for the channel's whole bend range either way
+        bend = round(pitch * self.bend_ranges.get(channel, self.BEND_RANGE) * self.FINE_STEPS / 8192)
+        self._log_pitch(channel, bend=max(-127, min(bend, 127)))
+
+    def log_control_change(self, channel, control, value):
+        if control == 1:
+            # the modulation wheel sets the vibrato depth, up to nearly half a semitone
+            self._log_pitch(channel, vibrato=value >> 4)
+        elif control == 101:
+            self.rpn[channel] = (value, self.rpn.get(channel, (127, 127))[1])
+        elif control == 100:
+            self.rpn[channel] = (self.rpn.get(channel, (127, 127))[0], value)
+        elif control == 6 and self.rpn.get(channel) == (0, 0):
+            self.bend_ranges[channel] = value   # RPN 0 is the pitch bend range
+
+    def _log_pitch(self, channel, bend=None, vibrato=None):
+        if channel not in self.preferred_chip:
+            return
+        old = self.channel_pitch.get(channel, (0, 0))
+        new = (old[0] if bend is None else bend, old[1] if vibrato is None else vibrato)
+        if new != old:
+            self.channel_pitch[channel] = new
+            self._ensure_event().pitch_changes.append((channel,) + new)
+
+    def analyze_loudness(self):
+        # once the whole song is logged, replaces each note's attenuation with one that takes its
+        # channel and passage into account (see loudness.py)
+        notes = self.logged_notes
+        times = np.fromiter((note.timestamp for note in notes), np.int64, len(notes))
+        channels = np.fromiter((note.channel for note in notes), np.int64, len(notes))
+        song = (np.array(self.song_times, dtype=np.int64), np.array(self.song_velocities, dtype=np.int64))
+        attens = loudness.attenuations(times, channels, np.array(self.logged_velocities, dtype=np.int64), song)
+        for note, atten in zip(notes, attens.tolist()):
+            note.atten = atten
+
+    def choose_clock(self, clock=None):
+        # picks the chip clock that plays the logged notes most in tune (see tuning.py), unless one is given
+        notes = [note.midi_note for note in self.logged_notes if note.channel != 10]
+        self.tuning, self.default_tuning = tuning.choose_clock(notes)
+        if clock:
+            self.tuning = tuning.Tuning(clock, notes)
+
     def write_output(self, outfile):
         self.outfile = outfile
+        if self.tuning:
+            self._write_clock(self.tuning.clock)
+        if self.lookahead:
+            self._plan_voices()
         pending_note_off_event = None
         for event in self.events:
             # if we have a note-off event followed by another event mere milliseconds later,
             # postpone the notes-off until the next event and consolidate delay events
             if pending_note_off_event:
-                if event.delay < 0.01:
+                if event.delay < 10_000:
                     event.merge(pending_note_off_event)
                 else:
                     self._write_event(pending_note_off_event)
                 pending_note_off_event = None
 
             # if this event is nothing but notes-off, see if we can merge it with the next one
-            if event.notes_off and not event.notes_on and not event.percussion:
+            if event.notes_off and not event.notes_on and not event.percussion and not event.pitch_changes:
                 pending_note_off_event = event
             else:
                 self._write_event(event)
@@ -108,7 +193,21 @@ class Encoder:
                 self.include_percussion = True
                 continue
             self.preferred_chip[ch] = chip
-            chip ^= 1
+            chip = (chip + 1) % self.chips
+
+    def _chip_voices(self, chip):
+        # odd-numbered chips fill from the top, so e.g. the two chips of a pair meet in the middle
+        voices = range(3 * chip, 3 * chip + 3)
+        if chip & 1:
+            return voices[::-1]
+        return voices
+
+    def _spill_voices(self, chip):
+        # the other chips' voices, each searched in the opposite order from its own notes
+        voices = []
+        for other in range(chip + 1, chip + self.chips):
+            voices.extend(self._chip_voices(other % self.chips)[::-1])
+        return voices
 
     def _find_lru_available_voice(self, voice_range):
         voice = None
@@ -124,35 +223,27 @@ class Encoder:
             chip = self.preferred_chip[note.channel]
 
             # find the least-recently used slot on the preferred chip
-            if chip == 0:
-                voice_range = range(0, 3)
-            else:
-                voice_range = range(5, 2, -1)
-            voice = self._find_lru_available_voice(voice_range)
+            voice = self._find_lru_available_voice(self._chip_voices(chip))
             if voice:
                 return voice
 
-            # no slots are available on the preferred chip, so see if we can spill to the other side
-            if chip == 0:
-                voice_range = range(3, 6)
-            else:
-                voice_range = range(2, -1, -1)
-            voice = self._find_lru_available_voice(voice_range)
+            # no slots are available on the preferred chip, so see if we can spill to another one
+            voice = self._find_lru_available_voice(self._spill_voices(chip))
             if voice:
                 return voice
 
             # all channels are busy: possibly preempt a playing note
             preempt_candidates = []
-            for v in range(6):
+            for v in range(self.voices):
                 playing_note = self.notes_playing[v]
                 if playing_note.channel in self.priority_channels:
                     continue    # don't preempt a note in a priority channel
                 # don't preempt a note that started too recently or it'll sound bad
                 if note.channel in self.priority_channels:
-                    time_threshold = 0.075
+                    time_threshold = 75_000
                 else:
-                    time_threshold = 0.15
-                if note.channel in priority_channels or note.timestamp - playing_note.timestamp > time_threshold:
+                    time_threshold = 150_000
+                if note.channel in self.priority_channels or note.timestamp - playing_note.timestamp > time_threshold:
                     playing_note.voice = v
                     preempt_candidates.append(playing_note)
             if preempt_candidates:
@@ -165,14 +256,76 @@ class Encoder:
             # this channel is excluded
             return None
 
+    # look-ahead allocation: since the whole song is in self.events, every note's release is known
+    # before anything is written. _plan_voices sweeps the notes in the order _write_event will see
+    # them and, whenever all voices are busy, weighs dropping the new note against cutting short each
+    # note that could be preempted, by how much (priority-weighted) note time would go unheard.
+    # a voice is reused only once its note has been released, so it's linear in the number of notes.
+
+    PRIORITY_WEIGHT = 4
+
+    def _find_note_ends(self):
+        # a note is released by the first later notes-off for its key, just as _write_event matches them;
+        # end_index is the event that releases it and end its time (or the last event, if nothing does)
+        last_timestamp = self._previous_timestamp()
+        held = {}
+        for i, event in enumerate(self.events):
+            for note_off in event.notes_off:
+                for note in held.pop((note_off.midi_note, note_off.channel), []):
+                    note.end_index = i
+                    note.end = event.timestamp
+            for note in event.notes_on:
+                note.end_index = len(self.events)
+                note.end = last_timestamp
+                held.setdefault((note.midi_note, note.channel), []).append(note)
+
+    def _note_weight(self, note):
+        if note.channel in self.priority_channels:
+            return self.PRIORITY_WEIGHT
+        return 1
+
+    def _plan_voices(self):
+        self._find_note_ends()
+        planned = [None] * self.voices
+        for i, event in enumerate(self.events):
+            for note in sorted(event.notes_on, key=lambda note: note.channel not in self.priority_channels):
+                note.planned_voice = self._plan_note(note, i, planned)
+                if note.planned_voice != None:
+                    planned[note.planned_voice] = note
+
+    def _plan_note(self, note, index, planned):
+        chip = self.preferred_chip[note.channel]
+
+        # a released voice on the preferred chip, or else on another one; of those, the one
+        # released longest ago, so its note gets the most release time
+        for voices in (self._chip_voices(chip), self._spill_voices(chip)):
+            free = [v for v in voices if planned[v] is None or planned[v].end_index <= index]
+            if free:
+                return min(free, key=lambda v: planned[v].end if planned[v] else -1)
+
+        # all voices are busy: cut short whichever note loses the least, unless dropping this one loses less
+        priority = note.channel in self.priority_channels
+        best_voice = None
+        best_cost = self._note_weight(note) * (note.end - note.timestamp)
+        for v in range(self.voices):
+            playing = planned[v]
+            if playing.channel in self.priority_channels:
+                continue    # don't preempt a note in a priority channel
+            if not priority and note.timestamp - playing.timestamp <= 150_000:
+                continue    # don't preempt a note that started too recently or it'll sound bad
+            cost = self._note_weight(playing) * (playing.end - note.timestamp)
+            if cost < best_cost:
+                best_voice, best_cost = v, cost
+        return best_voice
+
     def _write_event(self, event):
         # write delay
-        self._write_delay(event.delay)
+        self._write_delay(event.timestamp)
 
         # figure notes off
         notes_off_mask = 0
         for note_off in event.notes_off:
-            for v in range(6):
+            for v in range(self.voices):
                 if note_off.midi_note == self.notes_playing[v].midi_note and note_off.channel == self.notes_playing[v].channel:
                     self.notes_playing[v].midi_note = None
                     self.notes_playing[v].channel = None
@@ -183,13 +336,30 @@ class Encoder:
         # this looks funny because False sorts before True, but this sorts notes in priority channels first
         notes_on = sorted(event.notes_on, key=lambda note: note.channel not in self.priority_channels)
         for note_on in notes_on:
-            v = self._place_note(note_on)
-            if v != None:
+            if self.lookahead:
+                v = note_on.planned_voice
+            else:
+                v = self._place_note(note_on)
+            if v == None:
+                self.dropped_notes += 1
+            else:
+                if self.notes_playing[v].midi_note != None:
+                    self.preempted_notes += 1
                 self.notes_playing[v] = note_on
-                self._write_note_on(v, note_on.midi_note, note_on.velocity)
+                self._write_envelope(v, note_on.envelope)
+                self._write_pitch(v, note_on.bend, note_on.vibrato)
+                self._write_note_on(v, note_on.midi_note, note_on.atten)
                 # no need to write a note-off for this voice if we're starting a new note here now
                 notes_off_mask &= ~self._voice_bit(v)
 
+        # bend the notes playing in channels whose pitch bend or vibrato changed
+        if event.pitch_changes:
+            pitch = {channel: (bend, vibrato) for channel, bend, vibrato in event.pitch_changes}
+            for v in range(self.voices):
+                playing = self.notes_playing[v]
+                if playing.midi_note != None and playing.channel in pitch:
+                    self._write_pitch(v, *pitch[playing.channel])
+
         # translate and write percussion events
         if event.percussion:
             self._write_percussion(event.percussion)
@@ -198,55 +368,38 @@ class Encoder:
         if notes_off_mask != 0:
             self._write_notes_off(notes_off_mask)
 
-    HIGH_PERIODIC = 0
-    MID_PERIODIC = 1
-    LOW_PERIODIC = 2
-    HIGH_WHITE = 4
-    MID_WHITE = 5
-    LOW_WHITE = 6
-
-    LEFT_NOISE_PRIORITY = [
-        { 'notes': [35, 36, 41, 45], 'noise': LOW_WHITE, 'atten': 0, 'sustain': 0 }, # bass drum-ish
-        { 'notes': [51, 59], 'noise': HIGH_WHITE, 'atten': 4, 'sustain': 7 }, # ride cymbal
-        { 'notes': [0, 46, 53, 54, 55, 58, 70], 'noise': HIGH_WHITE, 'atten': 4, 'sustain': 3 }, # open hi-hat
-        { 'notes': [42, 44], 'noise': HIGH_WHITE, 'atten': 4, 'sustain': 0 } # closed hi-hat
-    ]
-
-    RIGHT_NOISE_PRIORITY = [
-        { 'notes': [37, 38, 39, 40, 52, 55], 'noise': HIGH_WHITE, 'atten': 0, 'sustain': 0 }, # snare-ish
-        { 'notes': [49, 57], 'noise': MID_WHITE, 'atten': 1, 'sustain': 7 }, # crash cymbal
-        { 'notes': [50, 56, 71, 72, 80, 81], 'noise': HIGH_PERIODIC, 'atten': 4, 'sustain': 1 }, # hi tom, etc.
-        { 'notes': [48, 60, 62, 63, 65, 67, 76], 'noise': MID_PERIODIC, 'atten': 4, 'sustain': 1 }, # mid tom, etc.
-        { 'notes': [47, 61, 64, 66, 68, 77], 'noise': LOW_PERIODIC, 'atten': 4, 'sustain': 1 } # low tom, etc.
+    # envelope profile (in firmware/envelopes.py) for each General MIDI instrument family of eight programs
+    PROGRAM_ENVELOPES = [
+        1, 1,       # piano, chromatic percussion: struck
+        2,          # organ
+        3, 3,       # guitar, bass: plucked
+        4, 4,       # strings, ensemble: bowed
+        5, 5, 5, 5, # brass, reed, pipe, synth lead: blown
+        4,          # synth pad: bowed
+        0,          # synth effects
+        3,          # ethnic: plucked
+        1,          # percussive: struck
+        0,          # sound effects
     ]
 
-    def _map_hit(self, priority, hits):
-        for info in priority:
-            for note in info['notes']:
-                if note in hits:
-                    return (info, hits[note])
-        return (None, None)
+    BEND_RANGE = 2      # semitones each way, the General MIDI default
+    FINE_STEPS = 16     # pitch bends and vibrato are in sixteenths of a semitone, as in MusicPlayer
 
     def _write_percussion(self, notes):
-        hits_by_midi_note = { hit.midi_note : hit for hit in notes }
-        info, note = self._map_hit(self.LEFT_NOISE_PRIORITY, hits_by_midi_note)
-        if info:
-            atten = info['atten'] + self._midi_velocity_to_attenuation(note.velocity)
-            self._write_noise(0, info['noise'], atten, info['sustain'])
-        info, note = self._map_hit(self.RIGHT_NOISE_PRIORITY, hits_by_midi_note)
-        if info:
-            atten = info['atten'] + self._midi_velocity_to_attenuation(note.velocity)
-            self._write_noise(1, info['noise'], atten, info['sustain'])
-
-    def _midi_velocity_to_attenuation(self, velocity):
-        return 7 - int((velocity + self.velocity_adjustment) / 16)
+        # each noise channel plays the hit whose note ranks first in its table
+        for voice, table in enumerate(self.percussion_tables[:self.chips]):
+            best, best_rank = None, 128
+            for hit in notes:
+                entry = table[hit.midi_note]
+                if entry and entry[0] <= best_rank:
+                    best, best_rank = hit, entry[0]
+            if best:
+                _, noise, atten, sustain = table[best.midi_note]
+                self._write_noise(voice, noise, min(atten + best.atten, 15), sustain)
 
     def _decode_voice(self, v):
         # skip the noise channels
-        if v < 3:
-            return v
-        else:
-            return v + 1
+        return (v // 3) * 4 + v % 3
 
     def _voice_bit(self, v):
         return 1 << self._decode_voice(v)
@@ -254,18 +407,49 @@ class Encoder:
     # note on: V = voice; A = attenuation; N = note
     # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
     #  0  0 V2 V1 V0 A3 A2 A1 A0 N6 N5 N4 N3 N2 N1 N0
-    def _write_note_on(self, v, note, velocity):
+    def _write_note_on(self, v, note, attenuation):
         voice = self._decode_voice(v)
-        attenuation = self._midi_velocity_to_attenuation(velocity)
+        self._select_bank(voice >> 3)
         u16 = (voice & 7) << 11
         u16 |= (attenuation & 0xF) << 7
         u16 |= (note & 0x7F)
         self._write16(u16)
 
+    # envelope: V = voice; P = envelope profile
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  1  1  0  0  0  0  1  0 V2 V1 V0 P4 P3 P2 P1 P0
+    def _write_envelope(self, v, envelope):
+        # the player keeps each voice's profile, so it's only written when it changes
+        if envelope != self.voice_envelopes[v]:
+            voice = self._decode_voice(v)
+            self._select_bank(voice >> 3)
+            self._write16(0xC200 | (voice & 7) << 5 | envelope)
+            self.voice_envelopes[v] = envelope
+
+    # pitch bend: V = voice; B = bend in fine steps, signed
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  0  1  0  0  1 V2 V1 V0 B7 B6 B5 B4 B3 B2 B1 B0
+    #
+    # vibrato: V = voice; D = depth in fine steps
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  1  1  0  0  0  0  1  1 V2 V1 V0 D4 D3 D2 D1 D0
+    def _write_pitch(self, v, bend, vibrato):
+        # like envelopes, these stay with the voice, so they're only written when they change
+        voice = self._decode_voice(v)
+        if bend != self.voice_bends[v]:
+            self._select_bank(voice >> 3)
+            self._write16(0x4800 | (voice & 7) << 8 | (bend & 0xFF))
+            self.voice_bends[v] = bend
+        if vibrato != self.voice_vibratos[v]:
+            self._select_bank(voice >> 3)
+            self._write16(0xC300 | (voice & 7) << 5 | vibrato)
+            self.voice_vibratos[v] = vibrato
+
     # noise on: V = voice; A = attenuation; S = sustain; N = noise type
     # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
     #  0  1  0  0  0 V0 S2 S1 S0 A3 A2 A1 A0 N2 N1 N0
     def _write_noise(self, voice, noise, atten, sustain):
+        self._select_bank(0)
         u16 = 0x4000
         u16 |= (voice & 0x1) << 10
         u16 |= (sustain & 0x7) << 7
@@ -276,61 +460,65 @@ class Encoder:
     # delay: D = delay in milliseconds
     # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
     #  1  0 DD DC DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
-    def _write_delay(self, delay):
-        delay = round(delay * 1000)
-        while delay > 0x3FFF:
-            self._write16(0xBFFF)
-            delay -= 0x3FFF
-        if delay > 0:
-            self._write16(0x8000 | delay)
+    #
+    # short delay: D = delay in microseconds
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  0  1  1 DC DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
+    #
+    # long delay: D = delay in units of 2^20 microseconds (about a second)
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  0  1  0  1 DB DA D9 D8 D7 D6 D5 D4 D3 D2 D1 D0
+    def _write_delay(self, timestamp):
+        # delays are worked out from the event's time less the time written so far, so rounding
+        # errors don't add up over a long song. anything under 8.192 ms is written exactly; longer
+        # delays are rounded to the millisecond, and any that won't fit in 14 bits of milliseconds
+        # start with long delays (one for every 71.6 minutes), so a silence takes two words unless it's longer
+        delay = timestamp - self.written_time
+        while delay > 0x3FFF * 1000:
+            units = min(delay >> 20, 0xFFF)
+            self._write16(0x5000 | units)
+            delay -= units << 20
+            self.written_time += units << 20
+        if delay >= 0x2000:
+            ms = (delay + 500) // 1000
+            self._write16(0x8000 | ms)
+            self.written_time += ms * 1000
+        elif delay > 0:
+            self._write16(0x6000 | delay)
+            self.written_time += delay
 
     # notes off: C = channel; V = voice mask
     # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
     #  1  1  0  0  0  0  0  0 V7 V6 V5 V4 V3 V2 V1 V0
     def _write_notes_off(self, voice_mask):
-        self._write16(0xC000 | voice_mask)
+        # one word per bank with voices to release, starting with the current one
+        banks = range((voice_mask.bit_length() + 7) // 8)
+        for bank in sorted(banks, key=lambda bank: bank != self.bank):
+            bank_mask = (voice_mask >> (bank * 8)) & 0xFF
+            if bank_mask:
+                self._select_bank(bank)
+                self._write16(0xC000 | bank_mask)
+
+    # bank select: B = pair of chips that following voice numbers refer to
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  1  1  0  0  0  0  0  1 B7 B6 B5 B4 B3 B2 B1 B0
+    # clock: C = the chips' clock in units of 20 kHz, or 0 for the player's default
+    # 15 14 13 12 11 10  9  8  7  6  5  4  3  2  1  0
+    #  1  1  0  0  0  1  0  0 C7 C6 C5 C4 C3 C2 C1 C0
+    def _write_clock(self, clock):
+        self._write16(0xC400 | max(1, min(round(clock / tuning.CLOCK_STEP), 0xFF)))
+
+    def _select_bank(self, bank):
+        if bank != self.bank:
+            self._write16(0xC100 | bank)
+            self.bank = bank
 
     def _write16(self, u16):
         self.outfile.write(u16.to_bytes(2, byteorder='big', signed=False))
 
-midi = MidiFile(args.infile)
-
 # NOTE: 1 is added to channels to match user-visible channel numbers in e.g. MuseScore
 
-# I feel like there should be a better way to enumerate channels, but whatevs...
-# I'll also find the maximum note velocity in this pass so I can normalize song volumes on the device
-all_channels = set()
-max_velocity = 0
-for msg in midi:
-    if msg.type == 'note_on':
-        all_channels.add(msg.channel + 1)
-        if msg.velocity > max_velocity:
-            max_velocity = msg.velocity
-
-# remove excluded channels
-if args.exclude_channels:
-    all_channels -= set(args.exclude_channels)
-
-# add priority channels
-if args.prioritize_channels:
-    priority_channels = set(args.prioritize_channels)
-else:
-    priority_channels = set()
-    melody_track_pattern = re.compile('melody|vocals', re.I)
-    for track in midi.tracks:
-        if melody_track_pattern.match(track.name):
-            track_channels = set()
-            for msg in track:
-                if msg.type == 'note_on':
-                    track_channels.add(msg.channel + 1)
-            print("{file}: prioritized melody track \"{name}\" channels {channels}".format(file=args.infile,name=track.name,channels=track_channels))
-            priority_channels = priority_channels.union(track_channels)
-
-
-encoder = Encoder(all_channels, priority_channels, max_velocity)
-for msg in midi:
-    if msg.time > 0:
-        encoder.log_delay(msg.time)
+def log_message(encoder, msg):
     if not msg.is_meta:
         if msg.type == 'note_on':
             if msg.velocity == 0:
@@ -339,11 +527,109 @@ for msg in midi:
                 encoder.log_note_on(msg.note, msg.channel + 1, msg.velocity)
         elif msg.type == 'note_off':
             encoder.log_note_off(msg.note, msg.channel + 1)
-
-if args.outfile == '-':
-    buf = io.BytesIO()
-    encoder.write_output(buf)
-    buf.seek(0, io.SEEK_SET)
-    PicoConnection().play_song(buf)
-else:
-    encoder.write_output(open(args.outfile, 'wb'))
+        elif msg.type == 'program_change':
+            encoder.log_program_change(msg.channel + 1, msg.program)
+        elif msg.type == 'pitchwheel':
+            encoder.log_pitch_bend(msg.channel + 1, msg.pitch)
+        elif msg.type == 'control_change':
+            encoder.log_control_change(msg.channel + 1, msg.control, msg.value)
+
+DEFAULT_TEMPO = 500_000    # microseconds per beat until the first set_tempo
+
+def timed_messages(midi):
+    # yields (time in microseconds, message) for all tracks merged. the running time is kept exactly,
+    # as an integer in units of 1/ticks_per_beat microseconds, and only rounded down for each message,
+    # so every time is within a microsecond of exact however long the song and however many tempo changes
+    tempo = DEFAULT_TEMPO
+    scaled_time = 0
+    # mido 1.3 merges the tracks once and keeps the result (which iterating the file uses too)
+    merged = midi.merged_track if hasattr(midi, 'merged_track') else merge_tracks(midi.tracks)
+    for msg in merged:
+        scaled_time += msg.time * tempo
+        yield scaled_time // midi.ticks_per_beat, msg
+        if msg.type == 'set_tempo':
+            tempo = msg.tempo
+
+def log_messages(encoder, midi):
+    previous_time = 0
+    for time, msg in timed_messages(midi):
+        if time > previous_time:
+            encoder.log_delay(time - previous_time)
+            previous_time = time
+        log_message(encoder, msg)
+
+def build_encoder(midi, prioritize_channels=None, exclude_channels=None, name='', chips=2, lookahead=False, kit=None,
+                  track_stats=None):
+    # track_stats is the midi's tracks.analyze, if the caller already has it
+    if track_stats is None:
+        track_stats = tracks.load(midi)
+    all_channels = tracks.channels(track_stats)
+
+    # remove excluded channels
+    if exclude_channels:
+        all_channels -= set(exclude_channels)
+
+    # add priority channels
+    if prioritize_channels:
+        priority_channels = set(prioritize_channels)
+    else:
+        priority_channels = tracks.melody_channels(track_stats, name)
+
+    return Encoder(all_channels, priority_channels, chips, lookahead, kit)
+
+def convert(midi, prioritize_channels=None, exclude_channels=None, name='', chips=2, lookahead=False, kit=None,
+            track_stats=None, clock=None):
+    # clock is the chips' clock in Hz, if it shouldn't be chosen for the song
+    encoder = build_encoder(midi, prioritize_channels, exclude_channels, name, chips, lookahead, kit, track_stats)
+    log_messages(encoder, midi)
+    encoder.analyze_loudness()
+    encoder.choose_clock(clock)
+    return encoder
+
+def print_allocation(encoder, name):
+    print("{file}: {dropped} notes dropped, {preempted} cut short".format(
+        file=name, dropped=encoder.dropped_notes, preempted=encoder.preempted_notes))
+
+def print_tuning(encoder, name):
+    print("{file}: chip clock {tuning}".format(file=name, tuning=encoder.tuning))
+    if encoder.tuning.clock != encoder.default_tuning.clock:
+        print("{file}: (the default clock would be {tuning})".format(file=name, tuning=encoder.default_tuning))
+
+def main():
+    parser = ArgumentParser(description='Convert MIDI file for pico_player')
+    parser.add_argument('infile', type=str, help='input midi file')
+    parser.add_argument('-p', '--prioritize-channels', type=int, metavar='CHANNEL', nargs='*',
+                        help='give specific channels priority when filling voices')
+    parser.add_argument('-x', '--exclude-channels', type=int, metavar='CHANNEL', nargs='*',
+                        help='exclude certain channels from the output file')
+    parser.add_argument('-c', '--chips', type=int, default=2, choices=range(1, 5),
+                        help='number of SN76489s on the player (set Sound.CHIPS to match)')
+    parser.add_argument('--lookahead', action='store_true',
+                        help='allocate voices knowing when every note ends, to drop and cut short fewer notes')
+    parser.add_argument('-k', '--kit', type=str,
+                        help='drum kit file mapping percussion to noise (see util/percussion.py)')
+    parser.add_argument('--clock', type=int,
+                        help='sound chip clock in Hz, in steps of 20 kHz (default: the one that plays the song most in tune)')
+    parser.add_argument('-d', '--device', type=str,
+                        help='serial device or other Pyboard device string to stream to (default: find the Pico)')
+    parser.add_argument('outfile', type=str, help='output binary file, or use - to stream to the Pico')
+    args = parser.parse_args()
+
+    midi = MidiFile(args.infile)
+    kit = percussion.load_kit(args.kit) if args.kit else None
+    encoder = convert(midi, args.prioritize_channels, args.exclude_channels, args.infile, args.chips, args.lookahead, kit,
+                      clock=args.clock)
+    print_tuning(encoder, args.infile)
+
+    if args.outfile == '-':
+        buf = io.BytesIO()
+        encoder.write_output(buf)
+        buf.seek(0, io.SEEK_SET)
+        print_allocation(encoder, args.infile)
+        PicoConnection(args.device).play_song(buf)
+    else:
+        encoder.write_output(open(args.outfile, 'wb'))
+        print_allocation(encoder, args.infile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+from argparse import ArgumentParser
+import sys
+import song_words
+from percussion import NOISE_NAMES
+
+# decodes the binary word stream produced by convert_midi.py, the same way MusicPlayer.play_word does,
+# and renders it as a readable event timeline
+
+NOTE_ON = 'note on'
+NOISE_ON = 'noise on'
+DELAY = 'delay'
+NOTES_OFF = 'notes off'
+BANK_SELECT = 'bank select'
+ENVELOPE = 'envelope'
+PITCH_BEND = 'pitch bend'
+VIBRATO = 'vibrato'
+CLOCK = 'clock'
+UNKNOWN = 'unknown'
+
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+class Command:
+    def __init__(self, word, kind, **fields):
+        self.word = word
+        self.kind = kind
+        self.__dict__.update(fields)
+
+    def __str__(self):
+        if self.kind == NOTE_ON:
+            return 'note on    voice {} {:<4} ({:3}) atten {}'.format(
+                self.voice, note_name(self.note), self.note, self.atten)
+        elif self.kind == NOISE_ON:
+            return 'noise on   voice {} {} atten {} sustain {}'.format(
+                self.voice, NOISE_NAMES[self.noise], self.atten, self.sustain)
+        elif self.kind == DELAY:
+            if self.word >= 0x8000:
+                return 'delay      {} ms'.format(self.us // 1000)
+            elif self.word >= 0x6000:
+                return 'delay      {} us'.format(self.us)
+            else:
+                return 'delay      {:.3f} s (long)'.format(self.us / 1e6)
+        elif self.kind == NOTES_OFF:
+            return 'notes off  voices {}'.format(voice_list(self.mask))
+        elif self.kind == BANK_SELECT:
+            return 'bank       {} (voices {}-{})'.format(self.bank, self.bank * 8, self.bank * 8 + 7)
+        elif self.kind == ENVELOPE:
+            return 'envelope   voice {} profile {}'.format(self.voice, self.profile)
+        elif self.kind == PITCH_BEND:
+            return 'bend       voice {} {:+.2f} semitones'.format(self.voice, self.bend / 16)
+        elif self.kind == VIBRATO:
+            return 'vibrato    voice {} depth {:.2f} semitones'.format(self.voice, self.depth / 16)
+        elif self.kind == CLOCK:
+            return 'clock      {:.2f} MHz'.format(self.clock / 1e6) if self.clock else 'clock      default'
+        else:
+            return 'unknown'
+
+def note_name(note):
+    return '{}{}'.format(NOTE_NAMES[note % 12], note // 12 - 1)
+
+def voice_list(mask):
+    return ','.join(str(v) for v in range(mask.bit_length()) if mask & (1 << v))
+
+def decode_word(word):
+    cmd = (word >> 14) & 0x3
+    if cmd == 0:
+        return Command(word, NOTE_ON, voice=(word & 0x3800) >> 11, atten=(word & 0x780) >> 7, note=word & 0x7F)
+    elif word < 0x4800:
+        return Command(word, NOISE_ON, voice=3 + 4 * ((word >> 10) & 1), sustain=(word >> 7) & 0x7,
+                       atten=(word >> 3) & 0xF, noise=word & 0x7)
+    elif word < 0x5000:
+        bend = word & 0xFF
+        return Command(word, PITCH_BEND, voice=(word >> 8) & 0x7, bend=bend - 256 if bend > 127 else bend)
+    elif word < 0x6000:
+        return Command(word, DELAY, us=(word & 0xFFF) << 20)
+    elif word < 0x8000:
+        return Command(word, DELAY, us=word & 0x1FFF)
+    elif cmd == 2:
+        return Command(word, DELAY, us=(word & 0x3FFF) * 1000)
+    elif word < 0xC100:
+        return Command(word, NOTES_OFF, mask=word & 0xFF)
+    elif word < 0xC200:
+        return Command(word, BANK_SELECT, bank=word & 0xFF)
+    elif word < 0xC300:
+        return Command(word, ENVELOPE, voice=(word >> 5) & 0x7, profile=word & 0x1F)
+    elif word < 0xC400:
+        return Command(word, VIBRATO, voice=(word >> 5) & 0x7, depth=word & 0x1F)
+    elif word < 0xC500:
+        return Command(word, CLOCK, clock=(word & 0xFF) * 20_000)     # 0 for the player's default
+    else:
+        return Command(word, UNKNOWN)
+
+def read_words(source):
+    # a filename (memory-mapped), file object or bytes
+    return song_words.load(source)
+
+def timeline(words, indices=None):
+    # yields (index, time in ms, command) for the words at indices (default: all of them); time is when
+    # the command takes effect on the Pico, and has a fractional part after short delays. voice numbers
+    # are made absolute, i.e. the selected bank is already applied
+    times = song_words.timestamps_us(words)
+    voice_bases = song_words.voice_bases(words)
+    if indices is None:
+        indices = range(len(words))
+    for i in indices:
+        command = decode_word(int(words[i]))
+        if command.kind == NOTES_OFF:
+            command.mask <<= int(voice_bases[i])
+        elif command.kind in (NOTE_ON, NOISE_ON, ENVELOPE, PITCH_BEND, VIBRATO):
+            command.voice += int(voice_bases[i])
+        yield int(i), times[i] / 1000, command
+
+def format_line(index, ms, command):
+    return '{:6}  {:13.6f}  {:04x}  {}'.format(index, ms / 1000, command.word, command)
+
+def main():
+    parser = ArgumentParser(description='Print the event timeline of a pico_player song file')
+    parser.add_argument('infile', type=str, help='song file produced by convert_midi.py, or - for stdin')
+    parser.add_argument('--no-delays', action='store_true', help='omit delay commands from the listing')
+    args = parser.parse_args()
+
+    if args.infile == '-':
+        words = read_words(sys.stdin.buffer)
+    else:
+        words = read_words(args.infile)
+
+    indices = None
+    if args.no_delays:
+        indices = (~song_words.is_delay(words)).nonzero()[0]
+    for index, ms, command in timeline(words, indices):
+        print(format_line(index, ms, command))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+from argparse import ArgumentParser
+import ast
+import hashlib
+import os
+import build_firmware
+from pico_connection import find_pico_port
+from pyboard import Pyboard, PyboardError
+
+# builds the firmware, uploads whatever changed to the Pico, and reports how long
+# `import music_player` takes (and how much RAM it costs) before and after
+
+IMPORT_PROBE = '''\
+import gc, utime
+gc.collect()
+m = gc.mem_free()
+t = utime.ticks_us()
+try:
+    import music_player
+    print((utime.ticks_diff(utime.ticks_us(), t), m - gc.mem_free()))
+except ImportError:
+    print(None)
+'''
+
+HASH_PROBE = '''\
+import uhashlib, ubinascii
+def _hash(path):
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    h = uhashlib.sha256()
+    b = bytearray(512)
+    while True:
+        n = f.readinto(b)
+        if not n:
+            break
+        h.update(b[:n])
+    f.close()
+    return ubinascii.hexlify(h.digest()).decode()
+print({name: _hash(name) for name in %r})
+'''
+
+def local_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _other_form(name):
+    # the counterpart that would shadow or be shadowed by this file on the device
+    base, ext = os.path.splitext(name)
+    if ext == '.mpy':
+        return base + '.py'
+    if ext == '.py' and name not in build_firmware.SOURCE_ONLY:
+        return base + '.mpy'
+    return None
+
+def _run(pyboard, code):
+    return ast.literal_eval(pyboard.exec_(code).decode().strip())
+
+def measure_import(pyboard):
+    # entering the raw REPL soft-resets the Pico, so nothing is imported yet
+    pyboard.enter_raw_repl()
+    return _run(pyboard, IMPORT_PROBE)
+
+def device_hashes(pyboard, names):
+    return _run(pyboard, HASH_PROBE % (names,))
+
+def format_import(result):
+    if result is None:
+        return 'not installed'
+    us, ram = result
+    return '{:.1f} ms, {:,} bytes of RAM'.format(us / 1000, ram)
+
+def deploy(pyboard, files, force=False):
+    before = measure_import(pyboard)
+    print('import music_player before: {}'.format(format_import(before)))
+
+    names = [os.path.basename(path) for path in files]
+    stale = [_other_form(name) for name in names]
+    stale = [name for name in stale if name and name not in names]
+    remote = device_hashes(pyboard, names + stale)
+
+    for path, name in zip(files, names):
+        if not force and remote[name] == local_hash(path):
+            print('{}: unchanged'.format(name))
+            continue
+        size, elapsed = pyboard.fs_put(path, name, fast=True)
+        print('{}: uploaded {:,} bytes in {:.2f} s'.format(name, size, elapsed))
+    for name in stale:
+        if remote[name] is not None:
+            pyboard.fs_rm(name)
+            print('{}: removed'.format(name))
+
+    after = measure_import(pyboard)
+    print('import music_player after: {}'.format(format_import(after)))
+
+def main():
+    parser = ArgumentParser(description='Build the firmware and upload it to the Pico')
+    parser.add_argument('-d', '--device', type=str, help='serial device or other Pyboard device string (default: find the Pico)')
+    parser.add_argument('--source', action='store_true', help='deploy .py source instead of compiling with mpy-cross')
+    parser.add_argument('--mpy-cross', type=str, default='mpy-cross', help='path to the mpy-cross compiler')
+    parser.add_argument('-f', '--force', action='store_true', help='upload every file, even if the device copy matches')
+    args = parser.parse_args()
+
+    files = build_firmware.build(mpy=not args.source, mpy_cross=args.mpy_cross)
+    pyboard = Pyboard(args.device or find_pico_port())
+    try:
+        deploy(pyboard, files, args.force)
+    except PyboardError as er:
+        print(er)
+    finally:
+        pyboard.exit_raw_repl()
+        pyboard.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+from argparse import ArgumentParser
+import collections
+import io
+import threading
+import time
+import mido
+import percussion
+from bench_repl import report
+from convert_midi import Encoder, Event, log_message, print_allocation
+from pico_connection import find_pico_port, PLAYER_SETUP, PLAYER_TEARDOWN
+from pyboard import Pyboard, PyboardError
+
+# plays MIDI input on the Pico as it happens. each message goes through the Encoder's voice
+# allocation on its own and is sent straight to MusicPlayer.play_live as a line of hex words,
+# with no batching and no delays: the Pico plays each line as soon as it arrives.
+#
+# the Pico acknowledges every line, and the time from a message arriving here to its
+# acknowledgement is kept for every message sent. that includes the trip back over USB,
+# so it's an upper bound on the time from a key press to the note starting.
+
+class LiveEncoder(Encoder):
+    # the Encoder fed one message at a time, timed by the host's clock instead of the song's delays
+    def __init__(self, priority_channels=(), exclude_channels=(), chips=2, kit=None):
+        channels = set(range(1, 17)) - set(exclude_channels)
+        # there's no song to analyze_loudness over, so each note's attenuation comes from its velocity alone
+        super().__init__(channels, set(priority_channels), chips, kit=kit)
+
+    def encode(self, msg, timestamp):
+        # returns the command words for msg (none, for anything but notes) as bytes;
+        # timestamp is the host's clock in microseconds
+        self.events = [Event(0, timestamp)]
+        self.logged_notes, self.logged_velocities = [], []
+        self.song_times, self.song_velocities = [], []
+        log_message(self, msg)
+        self.outfile = io.BytesIO()
+        self._write_event(self.events[0])
+        return self.outfile.getvalue()
+
+    def _write_delay(self, timestamp):
+        pass    # the Pico plays each message as it arrives
+
+class LivePlayer:
+    def __init__(self, device=None):
+        self.pyboard = Pyboard(device or find_pico_port())
+        self.pending = collections.deque()  # arrival times of the lines not acknowledged yet
+        self.latencies = []
+
+    def start(self):
+        self.pyboard.enter_raw_repl()
+        for command in PLAYER_SETUP:
+            self.pyboard.exec(command)
+        self.pyboard.exec_raw_no_follow('m.play_live()')
+        self.ack_reader = threading.Thread(target=self._read_acks, daemon=True)
+        self.ack_reader.start()
+
+    def send(self, data, received):
+        if not self.ack_reader.is_alive():
+            raise PyboardError('play_live stopped')
+        self.pending.append(received)
+        self.pyboard.serial.write(data.hex().encode('ascii') + b'\n')
+
+    def stop(self):
+        try:
+            self.pyboard.serial.write(b'\n')
+            self.ack_reader.join()
+            ret, ret_err = self.pyboard.follow(timeout=10)
+            if ret_err:
+                raise PyboardError('exception', ret, ret_err)
+            self.pyboard.exec(PLAYER_TEARDOWN)
+        finally:
+            self.pyboard.exit_raw_repl()
+            self.pyboard.close()
+
+    def _read_acks(self):
+        while True:
+            data = self.pyboard._read(1)
+            if data != b'\x06':
+                # play_live has returned (or raised); leave its output for follow()
+                self.pyboard.rx_buf[0:0] = data
+                return
+            self.latencies.append(time.perf_counter() - self.pending.popleft())
+
+def play_live(messages, encoder, player):
+    player.start()
+    try:
+        for msg in messages:
+            received = time.perf_counter()
+            data = encoder.encode(msg, round(received * 1_000_000))
+            if data:
+                player.send(data, received)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        player.stop()
+
+def open_messages(args):
+    if args.replay:
+        # plays the file in real time, as if it were coming in on a port
+        return mido.MidiFile(args.replay).play()
+    if args.virtual:
+        return mido.open_input(args.virtual, virtual=True)
+    return mido.open_input(args.port)
+
+def main():
+    parser = ArgumentParser(description='Play MIDI input on the Pico live, and measure the note latency')
+    parser.add_argument('-i', '--port', type=str, help='MIDI input port to open (default: the system default)')
+    parser.add_argument('--virtual', type=str, metavar='NAME',
+                        help='create a virtual input port for other programs to play into (rtmidi only)')
+    parser.add_argument('--replay', type=str, metavar='MIDIFILE', help='play a MIDI file in real time instead of a port')
+    parser.add_argument('-l', '--list', action='store_true', help='list the MIDI input ports and exit')
+    parser.add_argument('-d', '--device', type=str, help='serial device or other Pyboard device string (default: find the Pico)')
+    parser.add_argument('-p', '--prioritize-channels', type=int, metavar='CHANNEL', nargs='*', default=[],
+                        help='give specific channels priority when filling voices')
+    parser.add_argument('-x', '--exclude-channels', type=int, metavar='CHANNEL', nargs='*', default=[],
+                        help='ignore certain channels')
+    parser.add_argument('-c', '--chips', type=int, default=2, choices=range(1, 5),
+                        help='number of SN76489s on the player (set Sound.CHIPS to match)')
+    parser.add_argument('-k', '--kit', type=str,
+                        help='drum kit file mapping percussion to noise (see util/percussion.py)')
+    args = parser.parse_args()
+
+    if args.list:
+        for name in mido.get_input_names():
+            print(name)
+        return
+
+    kit = percussion.load_kit(args.kit) if args.kit else None
+    encoder = LiveEncoder(args.prioritize_channels, args.exclude_channels, args.chips, kit)
+    player = LivePlayer(args.device)
+    play_live(open_messages(args), encoder, player)
+
+    print_allocation(encoder, args.replay or args.virtual or args.port or 'input')
+    if player.latencies:
+        print('{} messages sent'.format(len(player.latencies)))
+        report('latency', player.latencies)
+
+if __name__ == '__main__':
+    main()
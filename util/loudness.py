@@ -0,0 +1,51 @@
+import numpy as np
+
+# loudness analysis for the converter: every note-on in the song at once, as arrays of time, channel and
+# velocity, to pick each note's attenuation. velocities map to decibels the way General MIDI suggests
+# (amplitude goes with velocity squared), and the SN76489 attenuates in 2 dB steps, so the loudest note
+# plays at full volume and the rest spread over the levels below it. the loudest note and passages are
+# judged over the whole song, even when only some of its notes are played (channels excluded, or one
+# board's share of a split), so every part keeps the same level. on top of that:
+#  * quiet passages are brought part of the way up towards the loudest one, judged in windows of a
+#    couple of seconds, so a soft introduction doesn't all land on the bottom few levels
+#  * a channel that is quiet throughout is brought up to a floor, so accompaniment stays audible
+# MAX_ATTEN keeps a few levels below the quietest note for the envelopes to decay through.
+
+DB_PER_STEP = 2
+MAX_ATTEN = 11
+WINDOW_US = 2_000_000
+PASSAGE_LIFT = 0.5          # the fraction of a passage's gap to the loudest passage that's made up
+CHANNEL_FLOOR_DB = -12      # the level each channel's loudest note is brought up to, at least
+
+def velocity_db(velocities, reference=127):
+    return 40 * np.log10(np.maximum(velocities, 1) / reference)
+
+def db_to_attenuation(db):
+    return np.clip(np.round(-db / DB_PER_STEP), 0, MAX_ATTEN).astype(np.int64)
+
+def velocity_table(reference=127):
+    # the attenuation for each velocity, without any analysis (for notes that aren't known in advance)
+    return db_to_attenuation(velocity_db(np.arange(128), reference)).tolist()
+
+def _window_peaks(windows, levels, at):
+    # the loudest level in each window at, and in its neighbours so the lift doesn't jump at window edges
+    peaks = np.full(max(windows.max(), at.max()) + 3, -np.inf)
+    np.maximum.at(peaks, windows + 1, levels)
+    peaks = np.maximum(np.maximum(peaks[:-2], peaks[1:-1]), peaks[2:])
+    return peaks[at]
+
+def attenuations(times, channels, velocities, song=None):
+    # the attenuation for each note, from its time in microseconds, channel and velocity. song is
+    # (times, velocities) of every note-on in the song, if these notes are only some of them
+    if not len(velocities):
+        return np.zeros(0, dtype=np.int64)
+    song_times, song_velocities = song if song is not None else (times, velocities)
+    reference = song_velocities.max()
+    levels = velocity_db(velocities, reference)
+    song_levels = velocity_db(song_velocities, reference)
+    levels = levels - _window_peaks(song_times // WINDOW_US, song_levels, times // WINDOW_US) * PASSAGE_LIFT
+
+    channel_peaks = np.full(channels.max() + 1, -np.inf)
+    np.maximum.at(channel_peaks, channels, levels)
+    levels = levels + np.maximum(CHANNEL_FLOOR_DB - channel_peaks, 0)[channels]
+    return db_to_attenuation(levels)
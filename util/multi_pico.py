@@ -0,0 +1,160 @@
+from argparse import ArgumentParser
+import asyncio
+import contextlib
+import io
+import time
+from mido import MidiFile
+import convert_midi
+import tracks
+from async_pico import AsyncPicoConnection
+from pico_connection import find_pico_ports, command_batches, PLAYER_SETUP, PLAYER_TEARDOWN
+
+# plays on several pico-players at once, either splitting one song's channels across them
+# (each board adds another six voices) or giving each board its own songs.
+#
+# the boards start together at a shared timestamp: each one's utime.ticks_us clock is mapped to
+# the host's clock by round trips, and between batches that mapping is re-measured and the
+# difference folded into the player's command time, so the boards don't drift apart.
+
+TICKS_PERIOD = 1 << 30  # utime.ticks_us wraps around at this on the rp2 port
+START_DELAY = 0.5       # seconds between measuring the clocks and starting to play
+DRIFT_INTERVAL = 5.0    # seconds between drift corrections
+DRIFT_TOLERANCE = 1000  # microseconds; smaller differences are within the noise of the round trips
+
+def _ticks_diff(a, b):
+    return ((a - b + TICKS_PERIOD // 2) % TICKS_PERIOD) - TICKS_PERIOD // 2
+
+class Board:
+    def __init__(self, device):
+        self.device = device
+        self.connection = AsyncPicoConnection(device)
+        self.pyboard = self.connection.pyboard
+        self.drift = 0
+
+    async def read_clock(self, samples=5):
+        # returns (host time, device ticks) from the round trip with the smallest latency,
+        # taking the device reading to be from the midpoint of the round trip
+        best = None
+        for _ in range(samples):
+            before = time.monotonic()
+            ticks = int(await self.pyboard.exec('print(utime.ticks_us())'))
+            after = time.monotonic()
+            if best is None or after - before < best[0]:
+                best = (after - before, (before + after) / 2, ticks)
+        return best[1], best[2]
+
+    async def prepare(self):
+        await self.connection.open()
+        await self.pyboard.enter_raw_repl()
+        for command in PLAYER_SETUP:
+            await self.pyboard.exec(command)
+
+    async def play(self, bufs, start, drift_interval=DRIFT_INTERVAL):
+        # plays bufs back to back, starting when the host's time.monotonic() reaches start
+        try:
+            host, ticks = await self.read_clock()
+            self.start = start
+            self.start_ticks = (ticks + round((start - host) * 1_000_000)) % TICKS_PERIOD
+            await self.pyboard.exec('t={}\r\nwhile utime.ticks_diff(t,utime.ticks_us())>0:pass'.format(self.start_ticks),
+                                    timeout=None)
+            last_check = time.monotonic()
+            for buf in bufs:
+                for command_queue in command_batches(buf):
+                    if time.monotonic() - last_check > drift_interval:
+                        await self._correct_drift()
+                        last_check = time.monotonic()
+                    await self.pyboard.exec('t=m.play_words({},t)\r\n'.format(command_queue), timeout=None)
+            await self.pyboard.exec(PLAYER_TEARDOWN)
+        except asyncio.CancelledError:
+            await self.pyboard.enter_raw_repl()
+            raise
+        finally:
+            await self.pyboard.exit_raw_repl()
+
+    async def _correct_drift(self):
+        # if the Pico's clock has run fast, its ticks are ahead of where the host says they should be,
+        # so push the command time later by the same amount (or earlier if it has run slow)
+        host, ticks = await self.read_clock(samples=3)
+        expected = (self.start_ticks + round((host - self.start) * 1_000_000)) % TICKS_PERIOD
+        drift = _ticks_diff(ticks, expected)
+        if abs(drift) >= DRIFT_TOLERANCE:
+            await self.pyboard.exec('t=utime.ticks_add(t,{})'.format(drift))
+            # from now on, the corrected ticks are the reference
+            self.start_ticks = (self.start_ticks + drift) % TICKS_PERIOD
+            self.drift += drift
+
+def partition_channels(track_stats, boards):
+    # balance channels across boards by note count; percussion can only go to one board
+    counts = tracks.note_counts(track_stats)
+    assignments = [set() for _ in range(boards)]
+    loads = [0] * boards
+    if 10 in counts:
+        assignments[0].add(10)
+        loads[0] += counts[10]
+    for channel in sorted((ch for ch in counts if ch != 10), key=lambda ch: -counts[ch]):
+        board = loads.index(min(loads))
+        assignments[board].add(channel)
+        loads[board] += counts[channel]
+    return assignments, set(counts)
+
+def _encode(midi, exclude_channels, name, track_stats=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        encoder = convert_midi.convert(midi, exclude_channels=exclude_channels, name=name, track_stats=track_stats)
+    buf = io.BytesIO()
+    encoder.write_output(buf)
+    buf.seek(0, io.SEEK_SET)
+    return buf
+
+def split_song(filename, boards):
+    midi = MidiFile(filename)
+    track_stats = tracks.load(midi)     # analyzed once for every board's conversion
+    assignments, all_channels = partition_channels(track_stats, boards)
+    return [[_encode(midi, all_channels - channels, filename, track_stats)] for channels in assignments], assignments
+
+def distribute_songs(filenames, boards):
+    queues = [[] for _ in range(boards)]
+    for i, filename in enumerate(filenames):
+        queues[i % boards].append(_encode(MidiFile(filename), None, filename))
+    return queues
+
+async def play_together(devices, queues):
+    boards = [Board(device) for device in devices]
+    try:
+        await asyncio.gather(*(board.prepare() for board in boards))
+        start = time.monotonic() + START_DELAY
+        await asyncio.gather(*(board.play(queue, start) for board, queue in zip(boards, queues)))
+        for board in boards:
+            print('{}: drift corrected by {:.1f} ms in total'.format(board.device, board.drift / 1000))
+    finally:
+        for board in boards:
+            await board.connection.close()
+
+def main():
+    parser = ArgumentParser(description='Play on several pico-players at once, in sync')
+    parser.add_argument('infiles', type=str, nargs='*', help='input midi files')
+    parser.add_argument('-d', '--devices', type=str, nargs='*', help='devices to use (default: every Pico attached)')
+    parser.add_argument('--songs', action='store_true',
+                        help='give each board its own songs, instead of splitting each song\'s channels across the boards')
+    parser.add_argument('-l', '--list', action='store_true', help='list the attached Picos and exit')
+    args = parser.parse_args()
+
+    devices = args.devices or find_pico_ports()
+    if args.list or not args.infiles:
+        for device in devices:
+            print(device)
+        return
+    if not devices:
+        raise RuntimeError("Pico not found")
+
+    if args.songs:
+        queues = distribute_songs(args.infiles, len(devices))
+        asyncio.run(play_together(devices, queues))
+    else:
+        for filename in args.infiles:
+            queues, assignments = split_song(filename, len(devices))
+            for device, channels in zip(devices, assignments):
+                print('{}: {} channels {}'.format(filename, device, sorted(channels)))
+            asyncio.run(play_together(devices, queues))
+
+if __name__ == '__main__':
+    main()
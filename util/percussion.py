@@ -0,0 +1,93 @@
+from argparse import ArgumentParser
+import json
+import sys
+
+# drum kits for the converter. channel 10's hits are played on the two noise channels, the left
+# chip's and the right chip's, and each has a list of sounds in priority order: when several drums
+# hit at once, each noise channel plays the first of its sounds that was hit. a sound is:
+#  notes:   the General MIDI percussion notes it plays for, the earlier the higher their priority
+#  noise:   the noise type, by name (see NOISE_NAMES)
+#  atten:   attenuation added to the hit's own, in 2 dB steps
+#  sustain: how long the noise rings, in MusicPlayer's sustain steps (0 to 7)
+# a kit file is JSON of the form {"left": [sound, ...], "right": [sound, ...]}; run this script
+# with an output file to get the default kit as a starting point.
+
+NOISE_NAMES = ['high periodic', 'mid periodic', 'low periodic', 'tone 3 periodic',
+               'high white', 'mid white', 'low white', 'tone 3 white']
+SIDES = ('left', 'right')
+
+DEFAULT_KIT = {
+    'left': [
+        { 'name': 'bass drum-ish', 'notes': [35, 36, 41, 45], 'noise': 'low white', 'atten': 0, 'sustain': 0 },
+        { 'name': 'ride cymbal', 'notes': [51, 59], 'noise': 'high white', 'atten': 4, 'sustain': 7 },
+        { 'name': 'open hi-hat', 'notes': [0, 46, 53, 54, 55, 58, 70], 'noise': 'high white', 'atten': 4, 'sustain': 3 },
+        { 'name': 'closed hi-hat', 'notes': [42, 44], 'noise': 'high white', 'atten': 4, 'sustain': 0 },
+    ],
+    'right': [
+        { 'name': 'snare-ish', 'notes': [37, 38, 39, 40, 52, 55], 'noise': 'high white', 'atten': 0, 'sustain': 0 },
+        { 'name': 'crash cymbal', 'notes': [49, 57], 'noise': 'mid white', 'atten': 1, 'sustain': 7 },
+        { 'name': 'hi tom, etc.', 'notes': [50, 56, 71, 72, 80, 81], 'noise': 'high periodic', 'atten': 4, 'sustain': 1 },
+        { 'name': 'mid tom, etc.', 'notes': [48, 60, 62, 63, 65, 67, 76], 'noise': 'mid periodic', 'atten': 4, 'sustain': 1 },
+        { 'name': 'low tom, etc.', 'notes': [47, 61, 64, 66, 68, 77], 'noise': 'low periodic', 'atten': 4, 'sustain': 1 },
+    ],
+}
+
+def _field(sound, key, limit):
+    value = sound.get(key, 0)
+    if not isinstance(value, int) or not 0 <= value <= limit:
+        raise ValueError('{} {!r} of {!r} should be 0 to {}'.format(key, value, sound.get('name', sound), limit))
+    return value
+
+def compile_sounds(sounds):
+    # a 128-entry table, indexed by MIDI note, of (rank, noise, atten, sustain) for the sound that
+    # note plays, or None. the rank is the note's place in the whole priority order, lowest first
+    table = [None] * 128
+    rank = 0
+    for sound in sounds:
+        noise = sound['noise']
+        if noise not in NOISE_NAMES:
+            raise ValueError('unknown noise {!r}; choose from {}'.format(noise, ', '.join(NOISE_NAMES)))
+        entry = (NOISE_NAMES.index(noise), _field(sound, 'atten', 15), _field(sound, 'sustain', 7))
+        for note in sound['notes']:
+            if not isinstance(note, int) or not 0 <= note < 128:
+                raise ValueError('note {!r} of {!r} is not a MIDI note'.format(note, sound.get('name', sound)))
+            if table[note] is None:     # a note listed twice plays the first sound it's listed for
+                table[note] = (rank,) + entry
+                rank += 1
+    return table
+
+def compile_kit(kit):
+    # one table for each noise channel, left then right
+    unknown = set(kit) - set(SIDES)
+    if unknown:
+        raise ValueError('unknown noise channels {}; a kit has {}'.format(sorted(unknown), ' and '.join(SIDES)))
+    return [compile_sounds(kit.get(side, [])) for side in SIDES]
+
+def load_kit(path):
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    parser = ArgumentParser(description='Write the default drum kit as a kit file to edit, or check a kit file')
+    parser.add_argument('outfile', type=str, nargs='?', help='kit file to write (default: print it)')
+    parser.add_argument('--check', type=str, metavar='KIT', help='load a kit file and report any errors instead')
+    args = parser.parse_args()
+
+    if args.check:
+        try:
+            tables = compile_kit(load_kit(args.check))
+        except (OSError, ValueError, KeyError) as e:
+            sys.exit('{}: {}'.format(args.check, e))
+        for side, table in zip(SIDES, tables):
+            print('{}: {} notes mapped'.format(side, sum(entry is not None for entry in table)))
+        return
+
+    text = json.dumps(DEFAULT_KIT, indent=2) + '\n'
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+if __name__ == '__main__':
+    main()
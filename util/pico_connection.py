@@ -1,36 +1,41 @@
 import serial
 from serial.tools import list_ports
 from pyboard import Pyboard
+import song_words
 
-class PicoConnection:
-    def __init__(self):
-        self.pyboard = None # to prevent another exception in the destructor if initialization fails
-        self.pyboard = Pyboard(self._find_pico_port())
+# borrowed from https://github.com/dhylands/rshell/blob/master/rshell/main.py
+def is_pico_usb_device(port):
+    if type(port).__name__ == 'Device':
+        # Assume its a pyudev.device.Device
+        if ('ID_BUS' not in port or port['ID_BUS'] != 'usb' or
+            'SUBSYSTEM' not in port or port['SUBSYSTEM'] != 'tty'):
+            return False
+        usb_id = 'usb vid:pid={}:{}'.format(port['ID_VENDOR_ID'], port['ID_MODEL_ID'])
+    else:
+        # Assume its a port from serial.tools.list_ports.comports()
+        usb_id = port[2].lower()
 
-    # borrowed from https://github.com/dhylands/rshell/blob/master/rshell/main.py
-    def _is_pico_usb_device(self, port):
-        if type(port).__name__ == 'Device':
-            # Assume its a pyudev.device.Device
-            if ('ID_BUS' not in port or port['ID_BUS'] != 'usb' or
-                'SUBSYSTEM' not in port or port['SUBSYSTEM'] != 'tty'):
-                return False
-            usb_id = 'usb vid:pid={}:{}'.format(port['ID_VENDOR_ID'], port['ID_MODEL_ID'])
-        else:
-            # Assume its a port from serial.tools.list_ports.comports()
-            usb_id = port[2].lower()
+    if usb_id.startswith('usb vid:pid=2e8a:0005'):
+        global USB_BUFFER_SIZE
+        USB_BUFFER_SIZE = 128
+        return True
 
-        if usb_id.startswith('usb vid:pid=2e8a:0005'):
-            global USB_BUFFER_SIZE
-            USB_BUFFER_SIZE = 128
-            return True
+    return False
 
-        return False
+def find_pico_ports():
+    return [port.device for port in serial.tools.list_ports.comports() if is_pico_usb_device(port)]
 
-    def _find_pico_port(self):
-        for port in serial.tools.list_ports.comports():
-            if self._is_pico_usb_device(port):
-                return port.device
+def find_pico_port():
+    ports = find_pico_ports()
+    if not ports:
         raise RuntimeError("Pico not found")
+    return ports[0]
+
+class PicoConnection:
+    def __init__(self, device=None):
+        # device is a serial port or any other Pyboard device string (such as exec:python3 pico_sim.py)
+        self.pyboard = None # to prevent another exception in the destructor if initialization fails
+        self.pyboard = Pyboard(device or find_pico_port())
 
     def _send_command_queue(self, commands):
         #print(commands)
@@ -39,28 +44,34 @@ class PicoConnection:
     def play_song(self, buf):
         try:
             self.pyboard.enter_raw_repl()
-            self.pyboard.exec("import utime\r\n")
-            self.pyboard.exec("from music_player import MusicPlayer\r\n")
-            self.pyboard.exec("m=MusicPlayer()\r\n")
-            self.pyboard.exec("m.start_playing()\r\n")
-            self.pyboard.exec("t=utime.ticks_ms()\r\n")
-            bytes = buf.read(2)
-            command_queue = []
-            while bytes:
-                cmd = int.from_bytes(bytes, byteorder='big')
-                # wait until a suitably long delay to send a command string,
-                # (or if the queue grows too long, send it anyway and risk an audible hiccup)
-                if len(command_queue) > 100 or ((cmd & 0xc000) == 0x8000 and (cmd & 0x3fff) > 100):
-                    self._send_command_queue(command_queue)
-                    command_queue.clear()
-                command_queue.append(cmd)
-                bytes = buf.read(2)
-            # send remaining commands followed by a one-second delay so notes can fade
-            command_queue.append(0x83e8)
-            self._send_command_queue(command_queue)
-            self.pyboard.exec("m.finish_playing()")
+            for command in PLAYER_SETUP:
+                self.pyboard.exec(command)
+            self.pyboard.exec(PLAYER_START)
+            for command_queue in command_batches(buf):
+                self._send_command_queue(command_queue)
+            self.pyboard.exec(PLAYER_TEARDOWN)
         except KeyboardInterrupt:
             # force a Ctrl+C to be sent to the Pico
             self.pyboard.enter_raw_repl()
         finally:
             self.pyboard.exit_raw_repl()
+
+PLAYER_SETUP = [
+    "import utime\r\n",
+    "from music_player import MusicPlayer\r\n",
+    "m=MusicPlayer()\r\n",
+    "m.start_playing()\r\n",
+]
+# t is the time of the last command, in the Pico's utime.ticks_us, which play_words carries from batch to batch
+PLAYER_START = "t=utime.ticks_us()\r\n"
+PLAYER_TEARDOWN = "m.finish_playing()"
+
+def command_batches(buf):
+    # split a song into lists of commands to hand to MusicPlayer.play_words
+    words = song_words.load(buf)
+    bounds = song_words.batch_bounds(words)
+    for start, end in bounds[:-1]:
+        yield words[start:end].tolist()
+    # send remaining commands followed by a one-second delay so notes can fade
+    last = words[bounds[-1][0]:bounds[-1][1]].tolist() if bounds else []
+    yield last + [0x83e8]
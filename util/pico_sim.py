@@ -0,0 +1,468 @@
+from argparse import ArgumentParser
+import binascii
+import gc
+import hashlib
+import math
+import os
+import queue
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+import _thread
+
+# a simulated pico-player, for running the host tools without the hardware. it's a process that talks
+# MicroPython's raw REPL (and raw paste) on stdin/stdout, so Pyboard can drive it as an exec: device:
+#
+#   python3 util/convert_midi.py song.mid - -d 'exec:python3 util/pico_sim.py'
+#
+# code runs under CPython with stand-ins for the MicroPython modules the firmware uses (machine,
+# rp2, utime, ...). the PIO state machines only model their FIFOs, so MusicPlayer runs at the speed
+# the real one would be held to by the chips, and the USB link delivers data in full-speed frames at
+# a limited bandwidth, so the timing seen by the host is roughly what a real Pico gives.
+#
+# files live in a root directory (a temporary one by default). modules that aren't found there are
+# imported from the firmware directory, as if they were frozen into the firmware.
+
+FIRMWARE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'firmware')
+TICKS_PERIOD = 1 << 30  # utime.ticks_us wraps around at this on the rp2 port
+RAW_REPL_BANNER = b'raw REPL; CTRL-B to exit\r\n'
+FRIENDLY_BANNER = b'MicroPython (pico_sim) on Raspberry Pi Pico with RP2040\r\nType "help()" for more information.\r\n>>> '
+PASTE_WINDOW = 128      # raw paste flow control window, in bytes
+PACKET_SIZE = 64        # USB full-speed bulk packet
+HEAP_SIZE = 192 * 1024  # what gc.mem_free() reports; the heap isn't modelled
+FIFO_DEPTH = 4          # words in a state machine's TX FIFO
+PUT_CYCLES = 34         # state machine cycles to take one word (the length of Sound's xfer program)
+
+def ticks_us():
+    # the host's monotonic clock, so the host can compare its own times with the device's ticks
+    return (time.monotonic_ns() // 1000) % TICKS_PERIOD
+
+def ticks_diff(a, b):
+    return ((a - b + TICKS_PERIOD // 2) % TICKS_PERIOD) - TICKS_PERIOD // 2
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.handler = None
+        self._value = value or 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+    __call__ = value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self.handler = handler
+
+class PWM:
+    def __init__(self, pin):
+        self.pin = pin
+        self._freq = 0
+        self._duty = 0
+
+    def freq(self, freq=None):
+        if freq is None:
+            return self._freq
+        self._freq = freq
+
+    def duty_u16(self, duty=None):
+        if duty is None:
+            return self._duty
+        self._duty = duty
+
+    def deinit(self):
+        self._duty = 0
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+    active = set()  # running timers, stopped by a soft reboot like the real ones
+
+    def __init__(self, id=-1, **kwargs):
+        self.stop = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=-1, period=-1, callback=None):
+        self.deinit()
+        interval = 1 / freq if freq > 0 else period / 1000
+        self.stop = threading.Event()
+        Timer.active.add(self)
+        threading.Thread(target=self._run, args=(mode, interval, callback, self.stop), daemon=True).start()
+
+    def deinit(self):
+        if self.stop:
+            self.stop.set()
+        Timer.active.discard(self)
+
+    def _run(self, mode, interval, callback, stop):
+        deadline = time.monotonic() + interval
+        while not stop.wait(max(0, deadline - time.monotonic())):
+            if callback:
+                callback(self)
+            if mode == Timer.ONE_SHOT:
+                break
+            deadline += interval
+
+class PIO:
+    IN_LOW = 0
+    IN_HIGH = 1
+    OUT_LOW = 2
+    OUT_HIGH = 3
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+    JOIN_NONE = 0
+    JOIN_TX = 1
+    JOIN_RX = 2
+
+def asm_pio(**kwargs):
+    # the program is never assembled; the state machine only needs to exist
+    return lambda program: program
+
+class StateMachine:
+    def __init__(self, id, program=None, freq=125_000_000, **kwargs):
+        self.id = id
+        self.word_time = PUT_CYCLES / freq
+        self.drained = 0   # when the words in the FIFO will all have been pulled
+        self.running = False
+        self.words = 0
+
+    def init(self, program, freq=125_000_000, **kwargs):
+        self.word_time = PUT_CYCLES / freq
+
+    def active(self, value=None):
+        if value is None:
+            return self.running
+        self.running = bool(value)
+
+    def put(self, value, shift=0):
+        # like the real put(), blocks while the FIFO is full
+        for _ in ([value] if isinstance(value, int) else value):
+            while self.drained - time.perf_counter() > FIFO_DEPTH * self.word_time:
+                pass
+            self.drained = max(self.drained, time.perf_counter()) + self.word_time
+            self.words += 1
+
+    def tx_fifo(self):
+        return max(0, math.ceil((self.drained - time.perf_counter()) / self.word_time))
+
+    def rx_fifo(self):
+        return 0
+
+    def get(self, buf=None, shift=0):
+        return 0
+
+    def exec(self, instr):
+        pass
+
+    def restart(self):
+        self.drained = 0
+
+def _ilistdir(path='.'):
+    for entry in os.scandir(path):
+        yield (entry.name, 0x4000 if entry.is_dir() else 0x8000, 0, entry.stat().st_size)
+
+def _unsupported(*args):
+    raise OSError(1, 'not supported by pico_sim')
+
+def install_modules():
+    sys.modules['machine'] = _module('machine', Pin=Pin, PWM=PWM, Timer=Timer,
+                                     freq=lambda hz=None: 125_000_000, unique_id=lambda: b'pico_sim')
+    sys.modules['rp2'] = _module('rp2', PIO=PIO, asm_pio=asm_pio, StateMachine=StateMachine)
+    sys.modules['utime'] = _module('utime', ticks_us=ticks_us, ticks_cpu=ticks_us,
+                                   ticks_ms=lambda: (time.monotonic_ns() // 1_000_000) % TICKS_PERIOD,
+                                   ticks_add=lambda ticks, delta: (ticks + delta) % TICKS_PERIOD,
+                                   ticks_diff=ticks_diff, time=time.time, sleep=time.sleep,
+                                   sleep_ms=lambda ms: time.sleep(ms / 1000), sleep_us=lambda us: time.sleep(us / 1e6))
+    sys.modules['micropython'] = _module('micropython', const=lambda value: value, native=lambda f: f,
+                                         viper=lambda f: f, schedule=lambda f, arg: f(arg),
+                                         kbd_intr=lambda chr: None, alloc_emergency_exception_buf=lambda size: None)
+    sys.modules['uhashlib'] = hashlib
+    sys.modules['ubinascii'] = binascii
+    sys.modules['uos'] = _module('uos', listdir=os.listdir, ilistdir=_ilistdir, remove=os.remove, mkdir=os.mkdir,
+                                 rmdir=os.rmdir, rename=os.rename, stat=os.stat, chdir=os.chdir, getcwd=os.getcwd,
+                                 mount=_unsupported, umount=_unsupported)
+    # the real gc, plus MicroPython's memory functions
+    sys.modules['gc'] = _module('gc', **{name: getattr(gc, name) for name in dir(gc) if not name.startswith('__')},
+                                mem_free=lambda: HEAP_SIZE, mem_alloc=lambda: 0)
+
+class UsbLink:
+    # one direction of the USB connection: each packet is handed on at the end of the frame in which
+    # it would have finished crossing a link of the given bandwidth
+    def __init__(self, deliver, bandwidth, frame_us):
+        self.deliver = deliver
+        self.byte_time = 1 / bandwidth
+        self.frame = frame_us / 1e6
+        self.busy_until = 0
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, data):
+        # empty data closes the link, once everything before it has been delivered
+        now = time.monotonic()
+        for i in range(0, len(data), PACKET_SIZE):
+            self.queue.put((now, data[i:i + PACKET_SIZE]))
+        if not data:
+            self.queue.put((now, data))
+
+    def _run(self):
+        while True:
+            sent, packet = self.queue.get()
+            self.busy_until = max(sent, self.busy_until) + len(packet) * self.byte_time
+            arrival = self.busy_until
+            if self.frame:
+                arrival = math.ceil(arrival / self.frame) * self.frame
+            delay = arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.deliver(packet)
+            if not packet:
+                return
+
+class Inbox:
+    # bytes received from the host, for the REPL and sys.stdin
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+        self.ready = threading.Condition()
+
+    def put(self, data):
+        with self.ready:
+            if data:
+                self.data += data
+            else:
+                self.closed = True
+            self.ready.notify()
+
+    def read(self, n=1, until=None):
+        # n bytes, or up to and including the byte until. waits with a timeout so that KeyboardInterrupt
+        # (raised by _thread.interrupt_main) gets through
+        with self.ready:
+            while True:
+                end = self.data.find(until) + 1 if until else (n if len(self.data) >= n else 0)
+                if end:
+                    data = bytes(self.data[:end])
+                    del self.data[:end]
+                    return data
+                if self.closed:
+                    raise EOFError
+                self.ready.wait(0.05)
+
+class DeviceInput:
+    def __init__(self, inbox):
+        self.inbox = inbox
+        self.buffer = self
+
+    def read(self, n=1):
+        return self.inbox.read(n).decode()
+
+    def readline(self):
+        return self.inbox.read(until=b'\n').decode()
+
+    def readinto(self, buf):
+        data = self.inbox.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+class DeviceOutput:
+    def __init__(self, device):
+        self.device = device
+        self.buffer = _module('buffer', write=self._write_bytes, flush=self.flush)
+
+    def write(self, text):
+        # MicroPython's console turns \n into \r\n
+        self.device.write(text.replace('\n', '\r\n').encode())
+        return len(text)
+
+    def _write_bytes(self, data):
+        self.device.write(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+class Device:
+    def __init__(self, root, firmware, bandwidth, frame_us, log=None):
+        self.root = root
+        self.log = log
+        self.inbox = Inbox()
+        self.executing = False
+        self.output = UsbLink(self._write_stdout, bandwidth, frame_us)
+        self.input = UsbLink(self._receive, bandwidth, frame_us)
+        sys.path[0:1] = [root, firmware]
+        sys.stdin = DeviceInput(self.inbox)
+        sys.stdout = DeviceOutput(self)
+        self.boot_modules = set(sys.modules)
+        self.soft_reboot()
+
+    def write(self, data):
+        self.output.send(data)
+
+    def _write_stdout(self, data):
+        while data:
+            data = data[os.write(1, data):]
+
+    def read_stdin(self):
+        while True:
+            data = os.read(0, 4096)
+            self.input.send(data)
+            if not data:
+                return
+
+    def _receive(self, data):
+        if self.executing and b'\x03' in data:
+            # ctrl-C interrupts the running program
+            _thread.interrupt_main()
+            data = data.replace(b'\x03', b'')
+            if not data:
+                return
+        self.inbox.put(data)    # b'' is the end of input
+
+    def soft_reboot(self):
+        for timer in list(Timer.active):
+            timer.deinit()
+        for name in set(sys.modules) - self.boot_modules:
+            del sys.modules[name]
+        os.chdir(self.root)
+        self.namespace = {'__name__': '__main__'}
+
+    def run(self):
+        raw = False
+        code = bytearray()
+        while True:
+            try:
+                c = self.inbox.read(1)
+            except KeyboardInterrupt:
+                continue    # a ctrl-C that arrived just as a program finished
+            if c == b'\x01':
+                raw = True
+                code.clear()
+                self.write(b'\r\n' + RAW_REPL_BANNER + b'>')
+            elif c == b'\x02':
+                raw = False
+                self.write(b'\r\n' + FRIENDLY_BANNER)
+            elif c == b'\x03':
+                code.clear()
+                if not raw:
+                    self.write(b'\r\n>>> ')
+            elif c == b'\x04':
+                if raw and code:
+                    self.write(b'OK')
+                    self.execute(bytes(code))
+                    code.clear()
+                    self.write(b'>')
+                else:
+                    self.soft_reboot()
+                    if raw:
+                        self.write(b'soft reboot\r\n' + RAW_REPL_BANNER + b'>')
+                    else:
+                        self.write(b'MPY: soft reboot\r\n' + FRIENDLY_BANNER)
+            elif c == b'\x05' and raw:
+                if self.inbox.read(2) == b'A\x01':
+                    self.execute(self.raw_paste())
+                    self.write(b'>')
+            elif raw:
+                code += c
+            # the friendly REPL doesn't echo or run anything; Pyboard only uses it to get to the raw REPL
+
+    def raw_paste(self):
+        self.write(b'R\x01' + PASTE_WINDOW.to_bytes(2, 'little'))
+        code = bytearray()
+        received = 0
+        while True:
+            c = self.inbox.read(1)
+            if c == b'\x04':
+                self.write(b'\x04')
+                return bytes(code)
+            code += c
+            received += 1
+            if received % PASTE_WINDOW == 0:
+                self.write(b'\x01')
+
+    def execute(self, code):
+        error = ''
+        self.executing = True
+        try:
+            exec(compile(code, '<stdin>', 'exec'), self.namespace)
+        except (Exception, KeyboardInterrupt) as e:
+            error = ''.join(traceback.format_exception(type(e), e, e.__traceback__.tb_next))
+        finally:
+            self.executing = False
+        self._instrument()
+        self.write(b'\x04' + error.replace('\n', '\r\n').encode() + b'\x04')
+
+    def _instrument(self):
+        # once music_player has been imported, every word MusicPlayer plays goes in the log as
+        # "<ticks_us when played> <cmd_time it was due> <word>"
+        if not self.log:
+            return
+        self.log.flush()
+        module = sys.modules.get('music_player')
+        if module is None or hasattr(module.MusicPlayer.play_word, 'logged'):
+            return
+        play_word = module.MusicPlayer.play_word
+        log = self.log
+        def logged_play_word(player, word, cmd_time):
+            log.write('{} {} {}\n'.format(ticks_us(), cmd_time, word))
+            return play_word(player, word, cmd_time)
+        logged_play_word.logged = True
+        module.MusicPlayer.play_word = logged_play_word
+
+def main():
+    parser = ArgumentParser(description='Simulated pico-player, talking the raw REPL on stdin and stdout')
+    parser.add_argument('--root', type=str, help='directory to use as the file system (default: a new temporary one)')
+    parser.add_argument('--firmware', type=str, default=FIRMWARE_DIR,
+                        help='directory of modules to import when they aren\'t in the file system')
+    parser.add_argument('--bandwidth', type=int, default=1_000_000, help='USB bandwidth each way, in bytes per second')
+    parser.add_argument('--frame-us', type=int, default=1000,
+                        help='USB frame length in microseconds, or 0 to deliver data as soon as it has crossed')
+    parser.add_argument('--log', type=str, help='file to log every word MusicPlayer plays to')
+    args = parser.parse_args()
+
+    # CPython hands the GIL around every 5 ms by default, which would hold up the USB link for as long as
+    # the player is busy-waiting
+    sys.setswitchinterval(0.0002)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    root = args.root or tempfile.mkdtemp(prefix='pico_sim_')
+    log = open(args.log, 'w') if args.log else None
+    try:
+        install_modules()
+        device = Device(os.path.abspath(root), os.path.abspath(args.firmware), args.bandwidth, args.frame_us, log)
+        threading.Thread(target=device.read_stdin, daemon=True).start()
+        device.run()
+    except EOFError:
+        pass
+    finally:
+        if log:
+            log.close()
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -71,6 +71,7 @@ import sys
 import time
 import os
 import ast
+import select
 
 try:
     stdout = sys.stdout.buffer
@@ -202,9 +203,21 @@ class ProcessToSerial:
         # res = self.sel.select(0)
         res = self.poll.poll(0)
         if res:
-            return 1
+            try:
+                import fcntl
+                import termios
+                import array
+
+                n = array.array("i", [0])
+                fcntl.ioctl(self.subp.stdout.fileno(), termios.FIONREAD, n)
+                return max(n[0], 1)
+            except (ImportError, OSError):
+                return 1
         return 0
 
+    def fileno(self):
+        return self.subp.stdout.fileno()
+
 
 class ProcessPtyToTerminal:
     """Execute a process which creates a PTY and prints slave PTY as
@@ -250,12 +263,16 @@ class ProcessPtyToTerminal:
     def inWaiting(self):
         return self.ser.inWaiting()
 
+    def fileno(self):
+        return self.ser.fileno()
+
 
 class Pyboard:
     def __init__(
         self, device, baudrate=115200, user="micro", password="python", wait=0, exclusive=True
     ):
         self.use_raw_paste = True
+        self.rx_buf = bytearray()
         if device.startswith("exec:"):
             self.serial = ProcessToSerial(device[len("exec:") :])
         elif device.startswith("execpty:"):
@@ -295,40 +312,87 @@ class Pyboard:
     def close(self):
         self.serial.close()
 
+    # All reads go through _read/_in_waiting, because read_until reads whatever is
+    # available in one go and pushes anything past the ending back into self.rx_buf.
+
+    def _read(self, size):
+        if self.rx_buf:
+            data = bytes(self.rx_buf[:size])
+            del self.rx_buf[:size]
+            if len(data) < size:
+                data += self.serial.read(size - len(data))
+            return data
+        return self.serial.read(size)
+
+    def _in_waiting(self):
+        return len(self.rx_buf) + self.serial.inWaiting()
+
+    def _wait_readable(self, timeout):
+        # block until the device sends something, or the timeout (None = forever) expires
+        try:
+            fd = self.serial.fileno()
+        except (AttributeError, OSError, ValueError):
+            # no pollable descriptor (e.g. telnet, or pyserial on Windows)
+            time.sleep(0.01)
+            return
+        select.select([fd], [], [], timeout)
+
+    def _read_available(self, timeout):
+        if self.rx_buf:
+            data = bytes(self.rx_buf)
+            del self.rx_buf[:]
+            return data
+        n = self.serial.inWaiting()
+        if n == 0:
+            self._wait_readable(timeout)
+            n = self.serial.inWaiting()
+            if n == 0:
+                return b""
+        return self.serial.read(n)
+
     def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None):
         # if data_consumer is used then data is not accumulated and the ending must be 1 byte long
         assert data_consumer is None or len(ending) == 1
 
-        data = self.serial.read(min_num_bytes)
-        if data_consumer:
-            data_consumer(data)
-        timeout_count = 0
+        data = self._read(min_num_bytes)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        scan_from = 0
         while True:
-            if data.endswith(ending):
-                break
-            elif self.serial.inWaiting() > 0:
-                new_data = self.serial.read(1)
+            end = data.find(ending, scan_from)
+            if end >= 0:
+                end += len(ending)
+                self.rx_buf[0:0] = data[end:]
+                data = data[:end]
                 if data_consumer:
-                    data_consumer(new_data)
-                    data = new_data
-                else:
-                    data = data + new_data
-                timeout_count = 0
+                    data_consumer(data)
+                    data = ending
+                break
+            if data_consumer:
+                data_consumer(data)
+                data = b""
+            scan_from = max(0, len(data) - len(ending) + 1)
+
+            if timeout is None:
+                remaining = None
             else:
-                timeout_count += 1
-                if timeout is not None and timeout_count >= 100 * timeout:
+                remaining = deadline - time.time()
+                if remaining <= 0:
                     break
-                time.sleep(0.01)
+            new_data = self._read_available(remaining)
+            if new_data and timeout is not None:
+                deadline = time.time() + timeout    # the timeout is for inactivity, as before
+            data = data + new_data
         return data
 
     def enter_raw_repl(self):
         self.serial.write(b"\r\x03\x03")  # ctrl-C twice: interrupt any running program
 
         # flush input (without relying on serial.flushInput())
-        n = self.serial.inWaiting()
+        n = self._in_waiting()
         while n > 0:
-            self.serial.read(n)
-            n = self.serial.inWaiting()
+            self._read(n)
+            n = self._in_waiting()
 
         self.serial.write(b"\r\x01")  # ctrl-A: enter raw REPL
         data = self.read_until(1, b"raw REPL; CTRL-B to exit\r\n>")
@@ -369,15 +433,15 @@ class Pyboard:
 
     def raw_paste_write(self, command_bytes):
         # Read initial header, with window size.
-        data = self.serial.read(2)
+        data = self._read(2)
         window_size = data[0] | data[1] << 8
         window_remain = window_size
 
         # Write out the command_bytes data.
         i = 0
         while i < len(command_bytes):
-            while window_remain == 0 or self.serial.inWaiting():
-                data = self.serial.read(1)
+            while window_remain == 0 or self._in_waiting():
+                data = self._read(1)
                 if data == b"\x01":
                     # Device indicated that a new window of data can be sent.
                     window_remain += window_size
@@ -416,7 +480,7 @@ class Pyboard:
         if self.use_raw_paste:
             # Try to enter raw-paste mode.
             self.serial.write(b"\x05A\x01")
-            data = self.serial.read(2)
+            data = self._read(2)
             if data == b"R\x00":
                 # Device understood raw-paste command but doesn't support it.
                 pass
@@ -439,7 +503,7 @@ class Pyboard:
         self.serial.write(b"\x04")
 
         # check if we could exec command
-        data = self.serial.read(2)
+        data = self._read(2)
         if data != b"OK":
             raise PyboardError("could not exec command (response: %r)" % data)
 
@@ -500,7 +564,12 @@ class Pyboard:
                 f.write(data)
         self.exec_("f.close()")
 
-    def fs_put(self, src, dest, chunk_size=256):
+    def fs_put(self, src, dest, chunk_size=256, fast=False):
+        # returns (bytes written, seconds taken)
+        if fast:
+            return self._fs_put_fast(src, dest)
+        start = time.time()
+        size = 0
         self.exec_("f=open('%s','wb')\nw=f.write" % dest)
         with open(src, "rb") as f:
             while True:
@@ -511,7 +580,44 @@ class Pyboard:
                     self.exec_("w(b" + repr(data) + ")")
                 else:
                     self.exec_("w(" + repr(data) + ")")
+                size += len(data)
         self.exec_("f.close()")
+        return size, time.time() - start
+
+    def _fs_put_fast(self, src, dest, window_size=4096, max_windows=4):
+        # Install a receiver on the device, then stream the file to it as base64 lines
+        # of window_size bytes, keeping up to max_windows unacknowledged windows in flight.
+        # base64 keeps Ctrl-C/Ctrl-D bytes out of the stream; the device checks a SHA-256.
+        import binascii
+        import hashlib
+
+        with open(src, "rb") as f:
+            data = f.read()
+        start = time.time()
+        self.exec_raw_no_follow(_fs_put_receiver_code + "_recv(%r,%u)" % (dest, len(data)))
+        in_flight = 0
+        for i in range(0, len(data), window_size):
+            if in_flight == max_windows:
+                self._fs_put_ack()
+                in_flight -= 1
+            self.serial.write(binascii.b2a_base64(data[i : i + window_size]))
+            in_flight += 1
+        while in_flight:
+            self._fs_put_ack()
+            in_flight -= 1
+        ret, ret_err = self.follow(timeout=10)
+        if ret_err:
+            raise PyboardError("exception", ret, ret_err)
+        if ret.strip() != hashlib.sha256(data).hexdigest().encode("ascii"):
+            raise PyboardError("fs_put: checksum mismatch writing %s" % dest)
+        return len(data), time.time() - start
+
+    def _fs_put_ack(self):
+        data = self._read(1)
+        if data != b"\x06":
+            # the receiver stopped; collect whatever it printed
+            ret, ret_err = self.follow(timeout=10)
+            raise PyboardError("exception", data + ret, ret_err)
 
     def fs_mkdir(self, dir):
         self.exec_("import uos\nuos.mkdir('%s')" % dir)
@@ -537,7 +643,7 @@ def execfile(filename, device="/dev/ttyACM0", baudrate=115200, user="micro", pas
     pyb.close()
 
 
-def filesystem_command(pyb, args):
+def filesystem_command(pyb, args, fast=False):
     def fname_remote(src):
         if src.startswith(":"):
             src = src[1:]
@@ -560,7 +666,7 @@ def filesystem_command(pyb, args):
             srcs = args[:-1]
             dest = args[-1]
             if srcs[0].startswith("./") or dest.startswith(":"):
-                op = pyb.fs_put
+                op = lambda src, dest: pyb.fs_put(src, dest, fast=fast)
                 fmt = "cp %s :%s"
                 dest = fname_remote(dest)
             else:
@@ -570,7 +676,10 @@ def filesystem_command(pyb, args):
                 src = fname_remote(src)
                 dest2 = fname_cp_dest(src, dest)
                 print(fmt % (src, dest2))
-                op(src, dest2)
+                ret = op(src, dest2)
+                if ret:
+                    size, elapsed = ret
+                    print("%u bytes in %.2f s (%.1f KiB/s)" % (size, elapsed, size / 1024 / max(elapsed, 1e-6)))
         else:
             op = {
                 "ls": pyb.fs_ls,
@@ -592,6 +701,23 @@ def filesystem_command(pyb, args):
         sys.exit(1)
 
 
+_fs_put_receiver_code = """\
+import sys, ubinascii, uhashlib
+def _recv(name, size):
+  f = open(name, 'wb')
+  h = uhashlib.sha256()
+  n = 0
+  while n < size:
+    b = ubinascii.a2b_base64(sys.stdin.readline())
+    f.write(b)
+    h.update(b)
+    n += len(b)
+    sys.stdout.write('\\x06')
+  f.close()
+  print(ubinascii.hexlify(h.digest()).decode())
+"""
+
+
 _injected_import_hook_code = """\
 import uos, uio
 class _FS:
@@ -669,6 +795,11 @@ def main():
         help="perform a filesystem action: "
         "cp local :device | cp :device local | cat path | ls [path] | rm path | mkdir path | rmdir path",
     )
+    cmd_parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="copy files to the device with a streaming receiver instead of one exec per chunk",
+    )
     cmd_parser.add_argument("files", nargs="*", help="input files")
     args = cmd_parser.parse_args()
 
@@ -715,7 +846,7 @@ def main():
 
         # do filesystem commands, if given
         if args.filesystem:
-            filesystem_command(pyb, args.files)
+            filesystem_command(pyb, args.files, args.fast)
             del args.files[:]
 
         # run the command, if given
@@ -0,0 +1,308 @@
+from argparse import ArgumentParser
+import os
+import time
+import wave
+import numpy as np
+import decode_dat
+import song_words
+from build_firmware import envelope_profiles, fine_period, fine_table, frequency_table, sound_clock_freq, vibrato_wave
+
+# renders pico_player song files to WAV without hardware.
+# PlayerModel replays the command stream the way MusicPlayer does (play_word, and the 80 Hz
+# _process_envelopes timer with the profiles from firmware/envelopes.py), recording every register
+# write it would send to the SN76489s; Synth then turns those writes into audio with NumPy, a block at a time.
+
+CLOCK_FREQ = sound_clock_freq()     # the player's default, for songs without a clock command
+ENVELOPE_HZ = 80
+TAIL_MS = 1000      # play_song sleeps this long after the last command so notes can fade
+VIBRATO_WAVE = vibrato_wave()   # firmware/envelopes.py, as MusicPlayer uses it
+
+# register writes, as recorded by PlayerModel
+TONE = 0
+ATTEN = 1
+NOISE = 2
+
+class PlayerModel:
+    def __init__(self, clock_freq=CLOCK_FREQ, chips=2):
+        self.default_clock = clock_freq
+        self._set_clock(clock_freq)
+        self.profiles, self.instant = envelope_profiles()
+        self.voices = 4 * chips
+        self.atten = [15] * self.voices
+        self.target = [15] * self.voices
+        self.sustain = [15] * self.voices
+        self.step_mask = [3] * self.voices
+        self.envelope = [0] * self.voices
+        self.envelope_clock = 0
+        self.note = [-1] * self.voices
+        self.period = [0] * self.voices
+        self.bend = [0] * self.voices
+        self.vibrato = [0] * self.voices
+        self.writes = []    # (time in ms, voice, register, value)
+        self.clocks = []    # (time in ms, clock in Hz) for each clock command
+
+    def run(self, words):
+        # the timer starts with playback, and its first tick comes one period later
+        tick_ms = 1000 / ENVELOPE_HZ
+        next_tick = tick_ms
+        # delays only move the clock, which the timeline has already worked out
+        commands = (~song_words.is_delay(words)).nonzero()[0]
+        for _, ms, command in decode_dat.timeline(words, commands):
+            while next_tick <= ms:
+                self._process_envelopes(next_tick)
+                next_tick += tick_ms
+            self._play_command(command, ms)
+        end_ms = (song_words.timestamps_us(words)[-1] / 1000 if len(words) else 0) + TAIL_MS
+        while next_tick <= end_ms:
+            self._process_envelopes(next_tick)
+            next_tick += tick_ms
+        return end_ms
+
+    def _play_command(self, command, ms):
+        if command.kind == decode_dat.NOTE_ON:
+            voice = command.voice
+            envelope = self.envelope[voice]
+            atten = command.atten
+            self.sustain[voice] = min(atten + self.profiles[envelope + 2], 15)
+            if self.profiles[envelope] == self.instant:
+                self.target[voice] = self.sustain[voice]
+                self.step_mask[voice] = self.profiles[envelope + 1]
+            else:
+                self.target[voice] = atten
+                self.step_mask[voice] = self.profiles[envelope]
+                atten = 15
+            self.atten[voice] = atten
+            self.note[voice] = command.note
+            if self.bend[voice] or self.vibrato[voice]:
+                self.period[voice] = self._pitch_period(voice)
+            else:
+                self.period[voice] = self.frequency_table[command.note]
+            self.writes.append((ms, voice, TONE, self.period[voice]))
+            self.writes.append((ms, voice, ATTEN, atten))
+        elif command.kind == decode_dat.NOISE_ON:
+            voice = command.voice
+            self.atten[voice] = command.atten
+            self.target[voice] = 15
+            self.sustain[voice] = 15
+            self.step_mask[voice] = command.sustain
+            self.writes.append((ms, voice, NOISE, command.noise))
+            self.writes.append((ms, voice, ATTEN, command.atten))
+        elif command.kind == decode_dat.NOTES_OFF:
+            for voice in range(self.voices):
+                if command.mask & (1 << voice):
+                    self.target[voice] = 15
+                    self.sustain[voice] = 15
+                    self.step_mask[voice] = self.profiles[self.envelope[voice] + 3]
+        elif command.kind == decode_dat.ENVELOPE:
+            if command.voice < self.voices and command.profile * 4 < len(self.profiles):
+                self.envelope[command.voice] = command.profile * 4
+        elif command.kind == decode_dat.PITCH_BEND:
+            voice = command.voice
+            if voice < self.voices:
+                self.bend[voice] = command.bend
+                if self.note[voice] >= 0:
+                    self._retune(ms, voice)
+        elif command.kind == decode_dat.VIBRATO:
+            if command.voice < self.voices:
+                self.vibrato[command.voice] = command.depth
+        elif command.kind == decode_dat.CLOCK:
+            self._set_clock(command.clock or self.default_clock)
+            self.clocks.append((ms, self.clock_freq))
+
+    def _set_clock(self, clock_freq):
+        self.clock_freq = clock_freq
+        self.frequency_table = frequency_table(clock_freq)
+        self.fine_base, self.fine_table = fine_table(clock_freq)
+
+    def _pitch_period(self, voice):
+        offset = self.bend[voice]
+        if self.vibrato[voice]:
+            offset += (self.vibrato[voice] * VIBRATO_WAVE[self.envelope_clock & 15]) >> 7
+        return fine_period(self.fine_base, self.fine_table, self.note[voice], offset)
+
+    def _retune(self, ms, voice):
+        period = self._pitch_period(voice)
+        if period != self.period[voice]:
+            self.period[voice] = period
+            self.writes.append((ms, voice, TONE, period))
+
+    def _process_envelopes(self, ms):
+        self.envelope_clock = (self.envelope_clock + 1) & 0xFF
+        for voice in range(self.voices):
+            if self.vibrato[voice] and self.note[voice] >= 0 and self.atten[voice] < 15:
+                self._retune(ms, voice)
+            if (self.step_mask[voice] & self.envelope_clock) == 0:
+                atten = self.atten[voice]
+                if atten < self.target[voice]:
+                    atten += 1
+                elif atten > self.target[voice]:
+                    atten -= 1
+                else:
+                    if atten < self.sustain[voice]:
+                        self.target[voice] = self.sustain[voice]
+                        self.step_mask[voice] = self.profiles[self.envelope[voice] + 1]
+                    continue
+                self.atten[voice] = atten
+                self.writes.append((ms, voice, ATTEN, atten))
+
+class Register:
+    # a register's value over time, as sorted change points; lookup() finds them for a block of samples
+    def __init__(self, initial):
+        self.samples = [0]
+        self.values = [initial]
+
+    def set(self, sample, value):
+        if self.samples[-1] == sample:
+            self.values[-1] = value
+        else:
+            self.samples.append(sample)
+            self.values.append(value)
+
+    def freeze(self):
+        self.samples = np.array(self.samples, dtype=np.int64)
+        self.values = np.array(self.values, dtype=np.int64)
+
+    def lookup(self, index):
+        return self.values[np.searchsorted(self.samples, index, side='right') - 1]
+
+def _lfsr_sequence(white):
+    # SN76489 15-bit noise shift register; white noise feeds back bits 0 and 1, periodic noise only bit 0
+    state = 0x4000
+    out = []
+    for _ in range(0x7FFF if white else 15):
+        out.append(state & 1)
+        if white:
+            feedback = (state ^ (state >> 1)) & 1
+        else:
+            feedback = state & 1
+        state = (state >> 1) | (feedback << 14)
+    return np.array(out, dtype=np.float64) * 2 - 1
+
+WHITE_SEQUENCE = _lfsr_sequence(True)
+PERIODIC_SEQUENCE = _lfsr_sequence(False)
+# 2 dB per attenuation step, and 15 is off
+VOLUME_TABLE = np.array([10 ** (-2 * a / 20) for a in range(15)] + [0.0])
+
+class Chip:
+    def __init__(self):
+        self.tone = [Register(0) for _ in range(3)]
+        self.atten = [Register(15) for _ in range(4)]
+        self.noise = Register(0)
+        self.noise_resets = []
+        # oscillator state carried between blocks
+        self.phase = [0.0] * 3
+        self.noise_count = 0.0
+        self.noise_base = 0.0
+
+    def freeze(self):
+        for register in self.tone + self.atten + [self.noise]:
+            register.freeze()
+        self.noise_resets = np.array(self.noise_resets, dtype=np.int64)
+
+    def render(self, index, clock_freq, sample_rate):
+        # clock_freq is the chip's clock at each sample
+        out = np.zeros(len(index))
+        periods = []
+        for channel in range(3):
+            period = self.tone[channel].lookup(index)
+            period = np.where(period == 0, 1024, period)    # a period of zero counts down from 1024
+            periods.append(period)
+            freq = clock_freq / (32.0 * period)
+            phase = self.phase[channel] + np.cumsum(freq / sample_rate)
+            self.phase[channel] = phase[-1] % 1.0
+            square = np.where(phase % 1.0 < 0.5, 1.0, -1.0)
+            square[freq > sample_rate / 2] = 0.0    # inaudible, and it would only alias
+            out += square * VOLUME_TABLE[self.atten[channel].lookup(index)]
+
+        mode = self.noise.lookup(index)
+        shift = mode & 3
+        noise_period = np.where(shift == 3, periods[2], 16 << np.minimum(shift, 2))
+        count = self.noise_count + np.cumsum(clock_freq / (32.0 * noise_period) / sample_rate)
+        # writing the noise register resets the shift register
+        resets = self.noise_resets[(self.noise_resets >= index[0]) & (self.noise_resets <= index[-1])]
+        bases = np.concatenate(([self.noise_base], count[resets - index[0]]))
+        base = bases[np.searchsorted(resets, index, side='right')]
+        self.noise_count = count[-1]
+        self.noise_base = bases[-1]
+        position = (count - base).astype(np.int64)
+        noise = np.where(mode & 4,
+                         WHITE_SEQUENCE[position % len(WHITE_SEQUENCE)],
+                         PERIODIC_SEQUENCE[position % len(PERIODIC_SEQUENCE)])
+        out += noise * VOLUME_TABLE[self.atten[3].lookup(index)]
+        return out
+
+class Synth:
+    def __init__(self, writes, end_ms, clock_freq=CLOCK_FREQ, sample_rate=44100, chips=2, clocks=()):
+        # clocks: (time in ms, clock in Hz) for each change of the chips' clock, as PlayerModel.clocks
+        self.clock = Register(clock_freq)
+        for ms, clock in clocks:
+            self.clock.set(int(round(ms * sample_rate / 1000)), clock)
+        self.clock.freeze()
+        self.sample_rate = sample_rate
+        self.length = int(end_ms * sample_rate / 1000)
+        self.chips = [Chip() for _ in range(chips)]
+        for ms, voice, register, value in writes:
+            sample = int(round(ms * sample_rate / 1000))
+            chip = self.chips[voice // 4]
+            channel = voice % 4
+            if register == TONE:
+                chip.tone[channel].set(sample, value)
+            elif register == ATTEN:
+                chip.atten[channel].set(sample, value)
+            else:
+                chip.noise.set(sample, value)
+                chip.noise_resets.append(sample)
+        for chip in self.chips:
+            chip.freeze()
+
+    def render(self, block_size=1 << 16):
+        # yields stereo int16 blocks: the left chip on the left channel, the right chip on the right
+        # (with more chips, even-numbered ones are on the left and odd-numbered ones on the right)
+        per_side = max(1, (len(self.chips) + 1) // 2)
+        for start in range(0, self.length, block_size):
+            index = np.arange(start, min(start + block_size, self.length))
+            stereo = np.zeros((len(index), 2))
+            clock = self.clock.lookup(index)
+            for i, chip in enumerate(self.chips):
+                stereo[:, i & 1] += chip.render(index, clock, self.sample_rate)
+            if len(self.chips) == 1:
+                stereo[:, 1] = stereo[:, 0]
+            yield (stereo * (0.9 * 32767 / (4 * per_side))).astype('<i2')
+
+def render_file(infile, outfile, clock_freq=CLOCK_FREQ, sample_rate=44100, chips=2):
+    words = decode_dat.read_words(infile)
+    model = PlayerModel(clock_freq, chips)
+    end_ms = model.run(words)
+    synth = Synth(model.writes, end_ms, clock_freq, sample_rate, chips, model.clocks)
+    with wave.open(outfile, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        for block in synth.render():
+            wav.writeframes(block.tobytes())
+    return end_ms / 1000
+
+def main():
+    parser = ArgumentParser(description='Render pico_player song files to WAV')
+    parser.add_argument('infiles', type=str, nargs='+', help='song files produced by convert_midi.py')
+    parser.add_argument('-o', '--output', type=str,
+                        help='output WAV file, or a directory when rendering several songs (default: next to each input)')
+    parser.add_argument('-r', '--sample-rate', type=int, default=44100, help='output sample rate')
+    parser.add_argument('--clock', type=int, default=CLOCK_FREQ, help="sound chip clock frequency in Hz, for songs that don't set their own")
+    parser.add_argument('-c', '--chips', type=int, default=2, help='number of SN76489s the song was converted for')
+    args = parser.parse_args()
+
+    for infile in args.infiles:
+        outfile = os.path.splitext(infile)[0] + '.wav'
+        if args.output and (len(args.infiles) > 1 or os.path.isdir(args.output)):
+            outfile = os.path.join(args.output, os.path.basename(outfile))
+        elif args.output:
+            outfile = args.output
+        start = time.perf_counter()
+        seconds = render_file(infile, outfile, args.clock, args.sample_rate, args.chips)
+        elapsed = time.perf_counter() - start
+        print('{} -> {}: {:.1f} s of audio in {:.2f} s ({:.0f}x real time)'.format(
+            infile, outfile, seconds, elapsed, seconds / elapsed))
+
+if __name__ == '__main__':
+    main()
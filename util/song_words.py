@@ -0,0 +1,78 @@
+import os
+import numpy as np
+
+# song files (.dat) as NumPy arrays of command words, so the host tools can classify, time and
+# split a song with array operations instead of a Python loop over every word.
+# the word ranges match MusicPlayer.play_word.
+
+WORD = np.dtype('>u2')
+
+NOTE_ON = 0
+NOISE_ON = 1
+PITCH_BEND = 2
+LONG_DELAY = 3
+SHORT_DELAY = 4
+DELAY = 5
+NOTES_OFF = 6
+BANK_SELECT = 7
+ENVELOPE = 8
+VIBRATO = 9
+CLOCK = 10
+UNKNOWN = 11
+
+# the first word of each kind after NOTE_ON, in order
+_KIND_STARTS = np.array([0x4000, 0x4800, 0x5000, 0x6000, 0x8000, 0xC000, 0xC100, 0xC200, 0xC300, 0xC400, 0xC500])
+
+def load(source):
+    # a read-only array of the song's words: a memory map of the file if source is a filename,
+    # otherwise the contents of a file object (from its current position) or of a bytes-like object
+    if isinstance(source, (str, os.PathLike)):
+        count = os.path.getsize(source) // 2
+        if count == 0:
+            return np.zeros(0, dtype=WORD)  # numpy can't map an empty file
+        return np.memmap(source, dtype=WORD, mode='r', shape=(count,))
+    if hasattr(source, 'read'):
+        source = source.read()
+    return np.frombuffer(source, dtype=WORD, count=len(source) // 2)
+
+def kinds(words):
+    return np.searchsorted(_KIND_STARTS, words, side='right').astype(np.uint8)
+
+def is_delay(words):
+    kind = kinds(words)
+    return (kind >= LONG_DELAY) & (kind <= DELAY)
+
+def delays_us(words):
+    # how long each word holds up playback, in microseconds (zero for anything but delays)
+    kind = kinds(words)
+    words = words.astype(np.int64)
+    delays = np.zeros(len(words), dtype=np.int64)
+    delays[kind == DELAY] = (words[kind == DELAY] & 0x3FFF) * 1000
+    delays[kind == SHORT_DELAY] = words[kind == SHORT_DELAY] & 0x1FFF
+    delays[kind == LONG_DELAY] = (words[kind == LONG_DELAY] & 0xFFF) << 20
+    return delays
+
+def timestamps_us(words):
+    # when each word takes effect, in microseconds from the start of the song (a delay's time is its end)
+    return np.cumsum(delays_us(words))
+
+def voice_bases(words):
+    # the voice number each word's voices are relative to, from the last bank select before it
+    selects = np.where(kinds(words) == BANK_SELECT, np.arange(len(words)), -1)
+    last_select = np.maximum.accumulate(selects) if len(words) else selects
+    return np.where(last_select >= 0, (words[last_select].astype(np.int64) & 0xFF) * 8, 0)
+
+def batch_bounds(words, max_words=101, gap_us=100_000):
+    # (start, end) of each batch for MusicPlayer.play_words. a batch starts at every delay longer than
+    # gap_us, since the Pico is waiting out the delay while the batch is being sent, and a batch that
+    # reaches max_words without one is cut there anyway (at the risk of an audible hiccup)
+    bounds = []
+    start = 0
+    for gap in list(np.flatnonzero(delays_us(words) > gap_us)) + [len(words)]:
+        while gap - start > max_words:
+            bounds.append((start, start + max_words))
+            start += max_words
+        if gap > start:
+            bounds.append((start, gap))
+            start = gap
+    return bounds
@@ -0,0 +1,171 @@
+from mido import MidiFile, MidiTrack, Message, MetaMessage, bpm2tempo
+import random
+
+# generators for synthetic MIDI files of controlled size and density,
+# for benchmarking and regression-testing convert_midi.py
+#
+# every generator takes a length in beats and a seed, so the same arguments always produce the same file.
+# channels are given as user-visible numbers (1-16) like everywhere else in the converter.
+
+TICKS_PER_BEAT = 480
+
+class TrackBuilder:
+    def __init__(self, name):
+        self.name = name
+        self.events = []    # (absolute tick, sort order, message)
+
+    def note(self, tick, duration, channel, note, velocity):
+        self.events.append((tick, 1, Message('note_on', channel=channel - 1, note=note, velocity=velocity)))
+        # alternate between real note-offs and zero-velocity note-ons, since MIDI files in the wild use both
+        if note & 1:
+            off = Message('note_off', channel=channel - 1, note=note)
+        else:
+            off = Message('note_on', channel=channel - 1, note=note, velocity=0)
+        self.events.append((tick + duration, 0, off))
+
+    def tempo(self, tick, bpm):
+        self.events.append((tick, 0, MetaMessage('set_tempo', tempo=bpm2tempo(bpm))))
+
+    def program(self, tick, channel, program):
+        self.events.append((tick, 0, Message('program_change', channel=channel - 1, program=program)))
+
+    def pitchwheel(self, tick, channel, pitch):
+        self.events.append((tick, 0, Message('pitchwheel', channel=channel - 1, pitch=pitch)))
+
+    def control(self, tick, channel, control, value):
+        self.events.append((tick, 0, Message('control_change', channel=channel - 1, control=control, value=value)))
+
+    def build(self):
+        track = MidiTrack()
+        track.append(MetaMessage('track_name', name=self.name))
+        tick = 0
+        for event_tick, _, msg in sorted(self.events, key=lambda e: (e[0], e[1])):
+            track.append(msg.copy(time=event_tick - tick))
+            tick = event_tick
+        track.append(MetaMessage('end_of_track', time=0))
+        return track
+
+def _midi_file(builders, conductor=None):
+    midi = MidiFile(ticks_per_beat=TICKS_PER_BEAT)
+    if conductor is None:
+        conductor = TrackBuilder('conductor')
+        conductor.tempo(0, 120)
+    midi.tracks.append(conductor.build())
+    for builder in builders:
+        midi.tracks.append(builder.build())
+    return midi
+
+def many_channels(beats=64, channels=12, density=4, seed=0):
+    # lots of independent parts, each playing `density` notes per beat, to overflow the six voices
+    rng = random.Random(seed)
+    builders = []
+    channel_numbers = [ch for ch in range(1, 17) if ch != 10][:channels]
+    for i, channel in enumerate(channel_numbers):
+        builder = TrackBuilder('melody' if i == 0 else 'part {}'.format(channel))
+        builder.program(0, channel, rng.randrange(128))
+        step = TICKS_PER_BEAT // density
+        base = 48 + (i * 5) % 36
+        for tick in range(0, beats * TICKS_PER_BEAT, step):
+            if rng.random() < 0.8:
+                duration = rng.randrange(step // 2, step * 3)
+                builder.note(tick, duration, channel, base + rng.randrange(12), rng.randrange(40, 128))
+        builders.append(builder)
+    return _midi_file(builders)
+
+def percussion_heavy(beats=64, density=8, seed=0):
+    # dense drum track on channel 10 over a simple bass line
+    rng = random.Random(seed)
+    drums = TrackBuilder('drums')
+    kit = [35, 36, 38, 40, 42, 44, 46, 49, 51, 57, 45, 47, 48, 50, 56, 60, 61, 62, 63, 64]
+    step = TICKS_PER_BEAT // density
+    for tick in range(0, beats * TICKS_PER_BEAT, step):
+        for note in rng.sample(kit, rng.randrange(1, 4)):
+            drums.note(tick, step // 2, 10, note, rng.randrange(60, 128))
+    bass = TrackBuilder('bass')
+    for beat in range(beats):
+        bass.note(beat * TICKS_PER_BEAT, TICKS_PER_BEAT - 20, 2, 36 + rng.randrange(12), 100)
+    return _midi_file([drums, bass])
+
+def sustained_chords(beats=64, voices=8, seed=0):
+    # long, overlapping chords wider than the available polyphony, with a melody on top
+    rng = random.Random(seed)
+    chords = TrackBuilder('pad')
+    for bar in range(0, beats, 4):
+        root = 40 + rng.randrange(12)
+        for i in range(voices):
+            # stagger the releases so voices free up one at a time
+            duration = 4 * TICKS_PER_BEAT + rng.randrange(-TICKS_PER_BEAT, TICKS_PER_BEAT)
+            chords.note(bar * TICKS_PER_BEAT, duration, 1 + i % 3, root + 4 * i, rng.randrange(50, 90))
+    melody = TrackBuilder('melody')
+    for half_beat in range(beats * 2):
+        melody.note(half_beat * TICKS_PER_BEAT // 2, TICKS_PER_BEAT // 2, 4, 72 + rng.randrange(12), 110)
+    return _midi_file([chords, melody])
+
+def tempo_changes(beats=64, changes_per_beat=2, seed=0):
+    # a steady part under a tempo map that changes constantly
+    rng = random.Random(seed)
+    conductor = TrackBuilder('tempo map')
+    for tick in range(0, beats * TICKS_PER_BEAT, TICKS_PER_BEAT // changes_per_beat):
+        conductor.tempo(tick, rng.randrange(60, 200))
+    melody = TrackBuilder('melody')
+    harmony = TrackBuilder('harmony')
+    for eighth in range(beats * 2):
+        tick = eighth * TICKS_PER_BEAT // 2
+        melody.note(tick, TICKS_PER_BEAT // 2 - 10, 1, 60 + rng.randrange(24), rng.randrange(70, 128))
+        if eighth % 4 == 0:
+            harmony.note(tick, 2 * TICKS_PER_BEAT, 2, 48 + rng.randrange(12), 80)
+    return _midi_file([melody, harmony], conductor)
+
+def expressive(beats=64, seed=0):
+    # a lead that bends into and between notes and swells its vibrato on long ones, over chords,
+    # with the lead's bend range widened to an octave
+    rng = random.Random(seed)
+    lead = TrackBuilder('melody')
+    for control, value in ((101, 0), (100, 0), (6, 12)):
+        lead.control(0, 1, control, value)
+    tick = 0
+    while tick < beats * TICKS_PER_BEAT:
+        duration = rng.choice([1, 2, 4]) * TICKS_PER_BEAT // 2
+        lead.note(tick, duration, 1, 60 + rng.randrange(24), rng.randrange(70, 128))
+        if rng.random() < 0.5:
+            # scoop up into the note and settle
+            for step in range(8):
+                lead.pitchwheel(tick + step * 20, 1, -2048 + step * 256)
+            lead.pitchwheel(tick + 160, 1, 0)
+        if duration >= 2 * TICKS_PER_BEAT:
+            for step in range(8):
+                lead.control(tick + TICKS_PER_BEAT // 2 + step * 60, 1, 1, step * 16)
+            lead.control(tick + duration, 1, 1, 0)
+        tick += duration
+    chords = TrackBuilder('chords')
+    for bar in range(0, beats, 4):
+        root = 48 + rng.randrange(12)
+        for i, interval in enumerate((0, 4, 7)):
+            chords.note(bar * TICKS_PER_BEAT, 4 * TICKS_PER_BEAT - 10, 2, root + interval, 70)
+        # a slow detune across the bar and back
+        for step in range(16):
+            chords.pitchwheel(bar * TICKS_PER_BEAT + step * TICKS_PER_BEAT // 4, 2, 600 - abs(step - 8) * 75)
+    return _midi_file([lead, chords])
+
+def controls_between_notes(beats=64, seed=0):
+    # short notes with rests between them, where only volume, pan and program changes happen,
+    # so the converter has to carry the time of messages that produce no commands
+    rng = random.Random(seed)
+    lead = TrackBuilder('melody')
+    for beat in range(beats):
+        tick = beat * TICKS_PER_BEAT
+        lead.note(tick, TICKS_PER_BEAT // 4, 1, 60 + rng.randrange(24), rng.randrange(70, 128))
+        lead.control(tick + TICKS_PER_BEAT // 2, 1, 7, rng.randrange(64, 128))
+        lead.control(tick + 3 * TICKS_PER_BEAT // 4, 1, 10, rng.randrange(128))
+        if beat % 4 == 3:
+            lead.program(tick + 7 * TICKS_PER_BEAT // 8, 1, rng.randrange(128))
+    return _midi_file([lead])
+
+GENERATORS = {
+    'many_channels': many_channels,
+    'percussion_heavy': percussion_heavy,
+    'sustained_chords': sustained_chords,
+    'tempo_changes': tempo_changes,
+    'expressive': expressive,
+    'controls_between_notes': controls_between_notes,
+}
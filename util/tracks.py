@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import re
+
+# track analysis for the converter: one pass over each track gathers statistics for every channel
+# it plays notes on, which give the song's channels and rank them to find the melody. a channel's
+# statistics within a track are:
+#  notes:     how many notes it plays
+#  low, high: its pitch range, as MIDI notes
+#  mean:      its mean pitch
+#  density:   notes per beat, from its first note to its last
+#  monophony: the fraction of its notes that start with none of its others held
+# the analysis of a MIDI file read from disk is cached in CACHE_DIR, keyed by the file's contents,
+# so converting the same files again (or one song for several boards) skips it.
+
+CACHE_DIR = os.environ.get('PICO_PLAYER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pico-player'))
+VERSION = 1     # bump when the statistics change, so older cache entries are ignored
+
+MELODY_NAMES = re.compile('melody|vocal|lead|solo', re.I)
+MELODY_SCORE = 0.5      # the score a channel needs to be taken for the melody without a track name saying so
+
+def analyze_track(track, index, ticks_per_beat):
+    channels = {}   # channel: [notes, low, high, pitch total, monophonic notes, first tick, last tick, held notes]
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        kind = msg.type
+        if kind == 'note_on':
+            stats = channels.get(msg.channel + 1)
+            if stats is None:
+                stats = channels[msg.channel + 1] = [0, 127, 0, 0, 0, tick, tick, set()]
+            note = msg.note
+            if not msg.velocity:
+                stats[7].discard(note)
+                continue
+            stats[0] += 1
+            if note < stats[1]:
+                stats[1] = note
+            if note > stats[2]:
+                stats[2] = note
+            stats[3] += note
+            held = stats[7]
+            if not held:
+                stats[4] += 1
+            stats[6] = tick
+            held.add(note)
+        elif kind == 'note_off':
+            stats = channels.get(msg.channel + 1)
+            if stats:
+                stats[7].discard(msg.note)
+
+    name = getattr(track, 'name', '')
+    result = []
+    for channel, (notes, low, high, total, monophonic, first, last, _) in sorted(channels.items()):
+        result.append({
+            'track': index,
+            'name': name,
+            'channel': channel,
+            'notes': notes,
+            'low': low if notes else 0,
+            'high': high,
+            'mean': total / notes if notes else 0,
+            'density': notes * ticks_per_beat / max(last - first, ticks_per_beat),
+            'monophony': monophonic / notes if notes else 0,
+        })
+    return result
+
+def analyze(midi):
+    # statistics for every channel of every track, in track order
+    stats = []
+    for index, track in enumerate(midi.tracks):
+        stats.extend(analyze_track(track, index, midi.ticks_per_beat))
+    return stats
+
+def _cache_path(filename):
+    with open(filename, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return os.path.join(CACHE_DIR, 'tracks', '{}-{}.json'.format(digest, VERSION))
+
+def load(midi):
+    # analyze(midi), from the cache if midi was read from a file that has been analyzed before
+    filename = getattr(midi, 'filename', None)
+    try:
+        path = _cache_path(filename) if filename else None
+    except OSError:
+        path = None
+    if not path:
+        return analyze(midi)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    stats = analyze(midi)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(stats, f)
+    except OSError:
+        pass    # no cache is no great loss
+    return stats
+
+def channels(stats):
+    return {entry['channel'] for entry in stats}
+
+def note_counts(stats):
+    counts = {}
+    for entry in stats:
+        if entry['notes']:
+            counts[entry['channel']] = counts.get(entry['channel'], 0) + entry['notes']
+    return counts
+
+def melody_score(entry):
+    # how much a channel in a track looks like a melody: one note at a time, in the treble,
+    # and at least a note every other beat or so. from 0 to 1
+    if entry['channel'] == 10 or not entry['notes']:
+        return 0
+    register = min(max((entry['mean'] - 48) / 24, 0), 1)    # C3 to C5
+    return entry['monophony'] * (0.25 + 0.75 * register) * min(entry['density'] * 2, 1)
+
+def rank_channels(stats):
+    # [(score, channel)] for every channel but percussion, the likeliest melody first
+    scores = {}
+    for entry in stats:
+        if entry['channel'] != 10:
+            scores[entry['channel']] = max(scores.get(entry['channel'], 0), melody_score(entry))
+    return sorted(((score, channel) for channel, score in scores.items()), reverse=True)
+
+def melody_channels(stats, name):
+    # the channels of tracks named as the melody; failing that, the best ranked channel if it's melodic enough
+    priority_channels = set()
+    named = {}
+    for entry in stats:
+        if MELODY_NAMES.search(entry['name']):
+            named.setdefault((entry['track'], entry['name']), set()).add(entry['channel'])
+    for (_, track_name), track_channels in named.items():
+        print("{file}: prioritized melody track \"{name}\" channels {channels}".format(
+            file=name, name=track_name, channels=track_channels))
+        priority_channels |= track_channels
+    if not priority_channels:
+        ranked = rank_channels(stats)
+        if ranked and ranked[0][0] >= MELODY_SCORE:
+            print("{file}: prioritized channel {channel} as the likeliest melody (score {score:.2f})".format(
+                file=name, channel=ranked[0][1], score=ranked[0][0]))
+            priority_channels.add(ranked[0][1])
+    return priority_channels
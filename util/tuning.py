@@ -0,0 +1,55 @@
+import numpy as np
+from build_firmware import sound_clock_freq
+
+# choosing the sound chips' clock for each song. a tone channel plays its clock / (32 * period), with
+# a 10-bit period: a slower clock reaches further down before MusicPlayer has to fold notes up an
+# octave, a faster one rounds the periods of high notes less. every clock the clock command can
+# give is tried on the song's notes, and the one with the least pitch error (in cents, averaged over
+# every note played) is written at the start of the song.
+
+CLOCK_STEP = 20_000         # the clock command's unit, as in MusicPlayer
+MIN_CLOCK = 500_000
+MAX_CLOCK = 4_000_000       # the fastest the SN76489 is rated for
+DEFAULT_CLOCK = sound_clock_freq()
+MARGIN_CENTS = 1.0          # a song stays on the default clock unless another is at least this much better
+
+def periods(clock, notes):
+    # the exact periods of MIDI notes at clock, before they're folded and rounded to fit the register
+    return clock / (32 * 440 * 2 ** ((notes - 69) / 12))
+
+def pitch_errors(clock, notes):
+    # the error of each MIDI note played at clock, in cents: the rounding of its period, plus 1200 for
+    # each octave it was folded up to fit the register (see MusicPlayer._init_frequency_table)
+    exact = periods(clock, notes)
+    octaves = np.maximum(np.ceil(np.log2(exact / 1023)), 0)
+    exact = exact / 2 ** octaves
+    registers = np.maximum(np.round(exact), 1)
+    return 1200 * (np.abs(np.log2(registers / exact)) + octaves)
+
+class Tuning:
+    # how well a clock plays a song's notes: every note played, or each distinct one with counts
+    def __init__(self, clock, notes, counts=None):
+        if counts is None:
+            notes, counts = np.unique(np.asarray(notes, dtype=np.int64), return_counts=True)
+        errors = pitch_errors(clock, notes)
+        self.clock = int(clock)
+        self.mean = float(errors @ counts / counts.sum()) if len(notes) else 0.0
+        self.max = float(errors.max()) if len(notes) else 0.0
+        self.folded = int(counts[periods(clock, notes) > 1023].sum())
+
+    def __str__(self):
+        return '{:.2f} MHz: mean error {:.1f} cents, worst {:.1f} cents, {} notes folded up'.format(
+            self.clock / 1e6, self.mean, self.max, self.folded)
+
+def choose_clock(notes):
+    # (Tuning at the best clock, Tuning at the default) for the MIDI notes of every note played
+    notes, counts = np.unique(np.asarray(notes, dtype=np.int64), return_counts=True)
+    default = Tuning(DEFAULT_CLOCK, notes, counts)
+    if not len(notes):
+        return default, default
+    clocks = np.arange(MIN_CLOCK, MAX_CLOCK + 1, CLOCK_STEP)
+    means = pitch_errors(clocks[:, None], notes[None, :]) @ counts / counts.sum()
+    best = np.argmin(means)
+    if default.mean - means[best] < MARGIN_CENTS:
+        return default, default
+    return Tuning(clocks[best], notes, counts), default